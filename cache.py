@@ -0,0 +1,135 @@
+'''
+Persistent cache of pairwise alignment results, kept in a local sqlite
+database so repeated runs over overlapping sequence sets skip the pairs
+already aligned. Entries are keyed by a hash of both sequences and of
+everything that determines their alignment: the costs, substitution matrix,
+node types, engine and engine version.
+@author: Todd Gillette and Parsa Hosseini
+'''
+
+import hashlib
+import sqlite3
+import time
+import engine
+
+default_cache_size = 1000000 # entries kept before the least recently used are evicted
+
+class AlignmentCache():
+    '''
+    A size-bounded, least recently used store of [score, alignment] results
+    of aligning one sequence to another. Alignments are optional: a result
+    stored without one serves score-only lookups only. The database
+    connection is opened lazily, so the cache can be sent to worker
+    processes, each of which opens its own.
+    @param fname: sqlite database file; created if missing.
+    @param scoring: ScoringScheme the results are computed with.
+    @param engine_type: alignment engine, 'array' or 'list'.
+    @param max_entries: number of entries kept.
+    '''
+    def __init__(self, fname, scoring, engine_type='array', max_entries=default_cache_size):
+        self.fname = fname
+        self.max_entries = max_entries
+        self.hits = 0 # lookups of this process answered from the cache
+        self.misses = 0
+        scheme = [sorted(scoring.costs.items()), sorted(scoring.submat.items()),
+                  sorted(scoring.node_types.items()), engine_type, engine.version]
+        self.scheme = hashlib.sha1(repr(scheme).encode()).hexdigest()
+        self.connection = None
+        # a database left larger by a run with more max_entries is shrunk on open
+        connection = self._connect()
+        with connection:
+            self._evict(connection)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['connection'] = None
+        return state
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.fname, timeout=600)
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS alignments '
+                                        '(key TEXT PRIMARY KEY, score, align1 TEXT, align2 TEXT, used REAL)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS alignments_used ON alignments (used)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+                self.connection.executemany('INSERT OR IGNORE INTO counters VALUES (?, 0)',
+                                            [('entries',), ('hits',), ('misses',)])
+        return self.connection
+
+    def key(self, seq1, seq2):
+        '''
+        @return: the cache key of aligning seq1 to seq2, both NeuriteSequences.
+        '''
+        return hashlib.sha1((self.scheme + '\t' + seq1.seq + '\t' + seq2.seq).encode()).hexdigest()
+
+    def lookup(self, seq1, queries, alignment=True):
+        '''
+        Gets the cached results of aligning seq1 to each query.
+        @param alignment: whether the results need the alignment.
+        @return: list of [score, alignment, query name] results, None where not cached.
+        '''
+        connection = self._connect()
+        results = []
+        used = []
+        for query in queries:
+            key = self.key(seq1, query)
+            row = connection.execute('SELECT score, align1, align2 FROM alignments WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None or (alignment and row[1] is None):
+                results.append(None)
+            else:
+                results.append([row[0], None if row[1] is None else (row[1], row[2]), query.name])
+                used.append(key)
+        hits, misses = len(used), len(queries) - len(used)
+        self.hits += hits
+        self.misses += misses
+        now = time.time()
+        with connection:
+            connection.executemany('UPDATE alignments SET used = ? WHERE key = ?', [(now, key) for key in used])
+            connection.execute('UPDATE counters SET value = value + ? WHERE name = ?', (hits, 'hits'))
+            connection.execute('UPDATE counters SET value = value + ? WHERE name = ?', (misses, 'misses'))
+        return results
+
+    def store(self, seq1, queries, results):
+        '''
+        Caches the [score, alignment, name] result of aligning seq1 to each
+        query, then evicts the least recently used entries over max_entries.
+        '''
+        connection = self._connect()
+        now = time.time()
+        rows = []
+        for query, result in zip(queries, results):
+            align1, align2 = result[1] if result[1] is not None else (None, None)
+            rows.append((self.key(seq1, query), result[0], align1, align2, now))
+        with connection:
+            inserted = connection.executemany('INSERT OR IGNORE INTO alignments VALUES (?, ?, ?, ?, ?)', rows).rowcount
+            # results that add an alignment to an entry stored without one
+            connection.executemany('UPDATE alignments SET align1 = ?, align2 = ?, used = ? '
+                                   'WHERE key = ? AND align1 IS NULL',
+                                   [row[2:] + row[:1] for row in rows if row[2] is not None])
+            connection.execute('UPDATE counters SET value = value + ? WHERE name = ?', (inserted, 'entries'))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        '''
+        Deletes the least recently used entries over max_entries, within the
+        caller's transaction.
+        '''
+        entries = connection.execute('SELECT value FROM counters WHERE name = ?', ('entries',)).fetchone()[0]
+        if entries > self.max_entries:
+            evicted = connection.execute('DELETE FROM alignments WHERE key IN (SELECT key FROM alignments '
+                                         'ORDER BY used LIMIT ?)', (entries - self.max_entries,)).rowcount
+            connection.execute('UPDATE counters SET value = value - ? WHERE name = ?', (evicted, 'entries'))
+
+    def counters(self):
+        '''
+        @return: dictionary of the 'entries', 'hits' and 'misses' counters of
+        the database, over all processes and runs.
+        '''
+        return dict(self._connect().execute('SELECT name, value FROM counters').fetchall())
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -6,6 +6,7 @@ from parameter import generate_sequence_set
 from msa import MultipleSequenceDriver, ConsensusFilterFactory
 import sequence
 import warnings
+import numpy
 
 class DomainSetBuilder():
     ''' 
@@ -16,11 +17,18 @@ class DomainSetBuilder():
     '''
     def __init__(self, consensus, win, max_gap, is_strip, is_enum=False, allowable_treeseq_types=None, node_types=sequence.default_nodetypes, min_win=1):
         if isinstance(consensus,str):
-            self.consensus_seq = consensus
-        else: # is NeuriteSequence
-            self.consensus_seq = consensus.seq
+            consensus = sequence.NeuriteSequence('consensus', consensus)
+        self.consensus_seq = consensus.seq
+        # Node type codes and gap flags per position, from the cached encoding
+        residue_codes = consensus.get_residue_codes()
+        type_codes = consensus.get_type_codes(node_types)
         if is_strip:
             self.consensus_seq = self.consensus_seq.replace('-','')
+            type_codes = type_codes[residue_codes != sequence.gap_code]
+            residue_codes = residue_codes[residue_codes != sequence.gap_code]
+        self.type_codes = type_codes.tolist()
+        # gap_counts[i] is the number of gaps in the first i positions
+        self.gap_counts = [0] + numpy.cumsum(residue_codes == sequence.gap_code).tolist()
 
         self.is_enumerate = is_enum # enumerate window size and max #/gaps
         self.win = win # sliding-window size
@@ -46,11 +54,11 @@ class DomainSetBuilder():
             else: # for each window, pull-out the respective domain
                 for idx in range(len(self.consensus_seq)):
                     sub_str = self.consensus_seq[idx: idx + w] # reference
-                    num_gap = sub_str.count('-') # count number of gaps
+                    num_gap = self.gap_counts[idx + len(sub_str)] - self.gap_counts[idx] # count number of gaps
                     # if required, candidate domain must be a complete tree
-                    if self.allowable_treeseq_types is None or sequence.tree_sequence_type(sub_str,self.node_types) in self.allowable_treeseq_types:
+                    if self.allowable_treeseq_types is None or sequence.coded_tree_sequence_type(self.type_codes[idx: idx + w]) in self.allowable_treeseq_types:
                         # only-gapped sequences are ignored (if stripped, there will be no gaps)
-                        if not re.match('^-+$', sub_str) and num_gap <= self.max_gap:
+                        if num_gap < len(sub_str) and num_gap <= self.max_gap:
                             if sub_str not in domains:
                                 domains[sub_str] = 0
                             domains[sub_str] += 1 # increment its abundance
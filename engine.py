@@ -0,0 +1,876 @@
+'''
+NumPy-backed dynamic programming kernels for the tree-aware alignment
+engines in pairwise.py. Scores, directions and gap states are held in typed
+arrays; unreachable cells hold -inf rather than None.
+@author: Todd Gillette and Parsa Hosseini
+'''
+
+import copy
+import numpy
+from sequence import type_a, type_c, type_t
+
+neg_inf = float('-inf') # marks an unreachable cell or an impossible gap
+
+# Version of the alignment results; cached results of other versions are not reused
+version = 1
+
+# Above this many DP cells alignments are traced back in linear memory
+default_linear_cells = 4000000
+
+# DP cells (summed over the batch) of one batch of BatchAlignmentKernel
+default_batch_cells = 1000000
+
+# Longest query aligned by BatchAlignmentKernel; its up-gap pass loops over the
+# columns in Python, so longer queries are faster with the single-pair kernel
+default_batch_length = 64
+
+# Full matrices of sequences at least this long are filled by anti-diagonals;
+# for shorter ones the per-operation overhead outweighs the scalar up-gap loop
+wavefront_length = 512
+
+def border_scores(seq, allowed, gap, gapopen):
+    '''
+    Scores for the first row (or column) of the DP matrix. A gap cannot start
+    within a subtree, so those positions are unreachable.
+    '''
+    border = numpy.full(len(seq) + 1, neg_inf)
+    border[0] = 0
+    if allowed:
+        a_count = 0
+        for i in range(1, len(seq) + 1):
+            # Update A(subtree) count
+            a_count += 1 if seq[i-1] == 'A' else -1 if seq[i-1] == 'T' else 0
+            if a_count <= 0:
+                border[i] = gap * i + gapopen
+    return border
+
+def open_extend(m, dir_score, direction, gap_cost, gapopen, gap_direction):
+    '''
+    Vectorised form of NeedlemanWunsch.determine_open_extend over a run of
+    cells. Returns the gap score and whether the gap extends a prior gap.
+    '''
+    gap_score = m + gap_cost
+    open_score = gap_score + gapopen
+    extend_score = dir_score + gap_cost
+    can_gap = dir_score != neg_inf # Previous position can gap
+    did_gap = direction == gap_direction # Previous position chose to gap
+    use_extend = can_gap & ~did_gap & (open_score < extend_score)
+    score = numpy.where(can_gap & did_gap, gap_score,
+                        numpy.where(use_extend, extend_score, open_score))
+    extend = can_gap & (did_gap | use_extend)
+    unreachable = m == neg_inf
+    score[unreachable] = neg_inf
+    extend[unreachable] = False
+    return score, extend
+
+def _row_array(values, first, last, blank, dtype):
+    '''
+    Converts a row computed as a list, of which only column 0 and columns
+    first..last were filled, to an array.
+    '''
+    row = numpy.full(len(values), blank, dtype=dtype)
+    row[0] = values[0]
+    row[first:last+1] = values[first:last+1]
+    return row
+
+class TreeAlignmentKernel():
+    '''
+    Fills the score, direction and directional gap matrices of the tree-aware
+    Needleman-Wunsch recurrence and performs its traceback.
+
+    Rows follow sequence 1 and columns sequence 2. Match and left-gap scores
+    only depend on earlier rows and are computed for a whole row at once;
+    up-gaps depend on the current row and are resolved left to right.
+
+    @param types1, types2: node type codes per position.
+    @param gaps1, gaps2: gap cost per position.
+    @param paired1, paired2: paired A position per T-node (-1 for the sentinel).
+    @param major1, major2: cost of gapping the subtree closed by each T-node.
+    @param match_row: callable returning the match scores of row i against
+    every position of sequence 2.
+    @param ac_up_row: callable returning, for row i, the score of matching each
+    position of sequence 2 (an A-node) with position i-1 of sequence 1.
+    @param border1, border2: scores of the first column and first row.
+    @param score_only: only keep the rows later rows depend on, i.e. the
+    previous row and those before still-open subtrees; no traceback is possible.
+
+    A band may be set to only fill the cells within a given distance of the
+    diagonal (see fit_band); cells outside it are unreachable.
+    @param bounds: per node of sequence 1 and 2, the cheapest cost of gapping
+    it (border and subtree gaps included) and an upper bound of the gain of
+    matching it rather than gapping both nodes of the pair, as arrays
+    (gaps1, gaps2, gains1, gains2); needed for banded alignment.
+    @param wavefront: fill the full matrices of long sequences by
+    anti-diagonals (see _fill_wavefront) rather than row by row.
+    '''
+    def __init__(self, types1, types2, gaps1, gaps2, paired1, paired2,
+                 major1, major2, match_row, ac_up_row, border1, border2,
+                 gapopen, allow_left=True, allow_up=True, score_only=False, bounds=None,
+                 wavefront=True):
+        self.types1, self.types2 = types1, types2
+        self.gaps1, self.gaps2 = gaps1, gaps2
+        self.paired1, self.paired2 = paired1, paired2
+        self.major1, self.major2 = major1, major2
+        self.match_row = match_row
+        self.ac_up_row = ac_up_row
+        self.border1, self.border2 = border1, border2
+        self.gapopen = gapopen
+        self.allow_left = allow_left
+        self.allow_up = allow_up
+        self.score_only = score_only # keep only the rows later rows depend on
+        self.bounds = bounds
+        self._gain_sums = None # cumulative gains per group of nodes (see _through_bound)
+        self.wavefront = wavefront # fill full matrices by anti-diagonals when large enough
+        self.top_score = None # score of the bottom-right cell
+        self.rows = None # live rows when score_only: row => (score, direction, left score)
+        self._release = None # row => rows which are no longer needed after it
+        self._columns = None
+        self.score = None # score matrix
+        self.direction = None # diag(0), left(1), up(2) matrix
+        self.left_score = None # left gap scores, extension and A-C match flags
+        self.left_extend = None
+        self.left_ac = None
+        self.up_score = None # up gap scores, extension and A-C match flags
+        self.up_extend = None
+        self.up_ac = None
+        self.band_lo = None # first and last column filled per row, or None
+        self.band_hi = None
+        self._border1, self._border2 = border1, border2
+
+    def set_band(self, band):
+        '''
+        Restricts the fill of each row i to the columns within band of
+        i * len(seq2) / len(seq1), so that the band runs corner to corner.
+        @param band: half width of the band, or None to fill every cell.
+        '''
+        l1, l2 = len(self.types1), len(self.types2)
+        if band is None or l1 == 0:
+            self.band_lo = self.band_hi = None
+            self._border1, self._border2 = self.border1, self.border2
+            return
+        center = (numpy.arange(l1 + 1) * l2 + l1 // 2) // l1
+        self.band_lo = numpy.maximum(center - band, 0)
+        self.band_hi = numpy.minimum(center + band, l2)
+        self._border1 = numpy.where(self.band_lo == 0, self.border1, neg_inf)
+        self._border2 = numpy.where(numpy.arange(l2 + 1) <= self.band_hi[0], self.border2, neg_inf)
+
+    def fill(self):
+        l1, l2 = len(self.types1), len(self.types2)
+        if self.score_only:
+            self.rows = self._advance(self._first_rows(), 0, l1)
+        else:
+            shape = (l1+1, l2+1)
+            self.score = numpy.zeros(shape)
+            self.direction = numpy.zeros(shape, dtype=numpy.int8)
+            self.left_score = numpy.zeros(shape)
+            self.left_extend = numpy.zeros(shape, dtype=bool)
+            self.left_ac = numpy.zeros(shape, dtype=bool)
+            self.up_score = numpy.zeros(shape)
+            self.up_extend = numpy.zeros(shape, dtype=bool)
+            self.up_ac = numpy.zeros(shape, dtype=bool)
+            self.score[:, 0] = self._border1
+            self.score[0, :] = self._border2
+            for m in (self.left_score, self.up_score):
+                m[1:, 0] = neg_inf
+                m[0, 1:] = neg_inf
+            # a band is filled row by row, so only the cells within it are visited
+            if self.wavefront and self.band_lo is None and min(l1, l2) >= wavefront_length:
+                self._fill_wavefront()
+            else:
+                up_columns = self._up_columns()
+                for i in range(1, l1 + 1):
+                    row = self._fill_row(i, up_columns)
+                    (self.score[i, 1:], self.direction[i, 1:], self.left_score[i, 1:],
+                     self.left_extend[i, 1:], self.left_ac[i, 1:], self.up_score[i, 1:],
+                     self.up_extend[i, 1:], self.up_ac[i, 1:]) = [r[1:] for r in row]
+        score = self._row(l1)[0][l2]
+        self.top_score = None if score == neg_inf else score
+        return self
+
+    def _fill_wavefront(self):
+        '''
+        Fills the full matrices one anti-diagonal at a time. Every transition
+        into a cell comes from an earlier anti-diagonal: the match and C-node
+        gaps from the neighbouring cells, and T-node gaps from the row or
+        column before the paired A. So each anti-diagonal is computed with
+        whole-array operations, gathering the subtree jumps through the
+        subtree index. The same operations as _fill_row are applied in the
+        same order, so the matrices are identical.
+
+        While filling, cell (i, j) is held at (i + j) * (l1 + 1) + i of flat
+        working arrays, so that anti-diagonals and their neighbours are
+        contiguous; the matrices are gathered from them at the end.
+        '''
+        l1, l2 = len(self.types1), len(self.types2)
+        width = l1 + 1
+        at = lambda i, j: (i + j) * width + i # working index of cell (i, j)
+        size = (l1 + l2 + 1) * width
+        score = numpy.full(size, neg_inf)
+        direction = numpy.zeros(size, dtype=numpy.int8)
+        left_score = numpy.full(size, neg_inf)
+        up_score = numpy.full(size, neg_inf)
+        flags = numpy.zeros((4, size), dtype=bool) # left extend, left A-C, up extend, up A-C
+        cells_i, cells_j = numpy.divmod(numpy.arange((l1 + 1) * (l2 + 1)), l2 + 1)
+        cells = at(cells_i, cells_j).reshape(l1 + 1, l2 + 1)
+        score[cells[:, 0]] = self.score[:, 0]
+        score[cells[0, :]] = self.score[0, :]
+        left_score[0] = up_score[0] = 0
+        # Match scores of each cell, and of the A-C matches of up gaps
+        matches = numpy.zeros(size)
+        matches[cells[1:, 1:]] = numpy.array([self.match_row(i) for i in range(1, l1 + 1)],
+                                             dtype=float).reshape(l1, l2)
+        if self.allow_up:
+            ac_matches = numpy.zeros(size)
+            ac_matches[cells[1:, 1:]] = numpy.array([self.ac_up_row(i) for i in range(1, l1 + 1)],
+                                                    dtype=float).reshape(l1, l2)
+        types1, types2 = self.types1, self.types2
+        gapopen = self.gapopen
+
+        # Per row of sequence 1: the row a left gap comes from and its cost
+        gap_rows = numpy.where(self.paired1 == -1, 0, self.paired1)
+        left_source = numpy.where(types1 == type_t, gap_rows, numpy.arange(l1))
+        left_cost = numpy.where(types1 == type_t, self.major1 + self.gaps1[gap_rows], self.gaps1)
+        left_ac_rows = (types1 == type_t) & (self.paired1 != -1)
+        # Per column of sequence 2: the column an up gap comes from and its cost
+        source, cost = self._up_columns()[3:]
+        up_source = numpy.array(source, dtype=numpy.intp)
+        up_cost = numpy.array(cost, dtype=float)
+        up_ac_columns = (types2 == type_t) & (self.paired2 != -1)
+
+        for d in range(2, l1 + l2 + 1):
+            first, last = max(1, d - l2), min(l1, d - 1)
+            i = numpy.arange(first, last + 1)
+            j = d - i
+            here = slice(d * width + first, d * width + last + 1)
+            t1, t2 = types1[i-1], types2[j-1]
+            prior = score[(d - 2) * width + first - 1:(d - 2) * width + last]
+            match = prior + matches[here]
+            match[(t2 != t1) | (prior == neg_inf)] = neg_inf
+
+            n = len(i)
+            if not self.allow_left:
+                left = numpy.full(n, neg_inf)
+                l_extend = l_ac = numpy.zeros(n, dtype=bool)
+            else:
+                src = left_source[i-1]
+                cell = at(src, j)
+                left, l_extend = open_extend(score[cell], left_score[cell], direction[cell],
+                                             left_cost[i-1], gapopen, 1)
+                no_gap = (t1 != type_c) & (t1 != type_t)
+                left[no_gap] = neg_inf
+                l_extend[no_gap] = False
+                # The paired A may instead be matched to a C in sequence 2
+                ac_rows = left_ac_rows[i-1] & (t2 == type_c)
+                prior_ac = score[cell - width]
+                ac_score = prior_ac + self.major1[i-1] + matches[at(src + 1, j)] + gapopen
+                l_ac = ac_rows & (prior_ac != neg_inf) & ((left == neg_inf) | (ac_score >= left))
+                left = numpy.where(l_ac, ac_score, left)
+                l_extend = l_extend & ~l_ac
+
+            if not self.allow_up:
+                up = numpy.full(n, neg_inf)
+                u_extend = u_ac = numpy.zeros(n, dtype=bool)
+            else:
+                k = up_source[j-1]
+                cell = at(i, k)
+                up, u_extend = open_extend(score[cell], up_score[cell], direction[cell],
+                                           up_cost[j-1], gapopen, 2)
+                is_a = t2 == type_a
+                up[is_a] = neg_inf
+                u_extend[is_a] = False
+                # Determine whether to match the T-paired A with this C
+                ac_columns = up_ac_columns[j-1] & (t1 == type_c)
+                prior_ac = score[cell - width - 1]
+                ac_score = prior_ac + self.major2[j-1] + ac_matches[cell + width] + gapopen
+                u_ac = ac_columns & (prior_ac != neg_inf) & ((up == neg_inf) | (ac_score >= up))
+                up = numpy.where(u_ac, ac_score, up)
+                u_extend = u_extend & ~u_ac
+
+            # As in _fill_row, where a reachable score beats any -inf
+            is_match = (match != neg_inf) & (match >= left) & (match >= up)
+            is_left = ~is_match & (left != neg_inf) & (left >= up)
+            is_up = ~is_match & ~is_left & (up != neg_inf)
+            score[here] = numpy.where(is_match, match, numpy.where(is_left, left, up))
+            direction[here] = is_left + 2 * is_up
+            left_score[here], up_score[here] = left, up
+            flags[:, here] = l_extend, l_ac, u_extend, u_ac
+
+        inner = cells[1:, 1:]
+        self.score[1:, 1:] = score[inner]
+        self.direction[1:, 1:] = direction[inner]
+        self.left_score[1:, 1:] = left_score[inner]
+        self.up_score[1:, 1:] = up_score[inner]
+        for m, flag in zip((self.left_extend, self.left_ac, self.up_extend, self.up_ac), flags):
+            m[1:, 1:] = flag[inner]
+
+    def _first_rows(self):
+        '''
+        The live rows before any row of sequence 1 has been filled.
+        '''
+        shape = self._border2.shape
+        left_score = numpy.full(shape, neg_inf)
+        left_score[..., 0] = 0
+        return {0: (self._border2.copy(), numpy.zeros(shape, dtype=numpy.int8), left_score)}
+
+    def _advance(self, rows, start, stop, flags=None):
+        '''
+        Continues a score-only fill from the rows live after row start up to
+        row stop, releasing rows which are no longer needed.
+        @param flags: if a dictionary, the traceback flags of each new row are
+        kept in it as (direction, left extend, left A-C, up extend, up A-C).
+        @return: dictionary of the rows live after row stop.
+        '''
+        if self._release is None:
+            self._release = self._row_releases()
+            self._columns = self._up_columns()
+        self.rows = dict(rows)
+        for i in range(start + 1, stop + 1):
+            row = self._fill_row(i, self._columns)
+            self.rows[i] = row[:3]
+            if flags is not None:
+                flags[i] = (row[1], row[3], row[4], row[6], row[7])
+            for done in self._release.get(i, ()):
+                self.rows.pop(done, None)
+        return self.rows
+
+    def _row_releases(self):
+        '''
+        For score-only filling, determines after which row each stored row can
+        be dropped: the previous row once the next is done, and the row before
+        an A-node once its paired T-node has gapped back to it. Row 0 is kept
+        for the sentinal T-node.
+        @return: dictionary of row => rows which can be released after it.
+        '''
+        l1 = len(self.types1)
+        last_use = {r: r + 1 for r in range(1, l1 + 1)}
+        if self.allow_left:
+            for t in numpy.flatnonzero(self.types1 == type_t).tolist():
+                paired = self.paired1[t]
+                if paired > 0:
+                    last_use[paired] = max(last_use[paired], t + 1)
+        release = {}
+        for r, last in last_use.items():
+            release.setdefault(last, []).append(r)
+        return release
+
+    def _row(self, r):
+        '''
+        Score, direction and left-gap score of a filled row.
+        '''
+        if self.score_only:
+            return self.rows[r]
+        return self.score[r], self.direction[r], self.left_score[r]
+
+    def _up_columns(self):
+        '''
+        Per-column constants of the up-gap recurrence, as python lists so the
+        sequential part of each row avoids numpy scalar overhead.
+        '''
+        types2 = self.types2.tolist()
+        paired2 = self.paired2.tolist()
+        gaps2 = self.gaps2.tolist()
+        major2 = self.major2.tolist()
+        source, cost = [], []
+        for k in range(len(types2)):
+            if types2[k] == type_t:
+                # Gap until the paired A; the sentinal gaps from the start
+                pos = 0 if paired2[k] == -1 else paired2[k]
+                source.append(pos)
+                cost.append(major2[k] + gaps2[pos])
+            else:
+                source.append(k)
+                cost.append(gaps2[k])
+        return types2, paired2, major2, source, cost
+
+    def _left_gap(self, i, first=1, last=None):
+        '''
+        Scores for gapping sequence 1 at row i, for columns first..last (of
+        every query, for a batch); every column by default.
+        '''
+        if last is None:
+            last = self.types2.shape[-1]
+        here, prior_cols = slice(first, last + 1), slice(first - 1, last)
+        types2 = self.types2[..., prior_cols]
+        shape = types2.shape
+        node_type = self.types1[i-1]
+        left = numpy.full(shape, neg_inf)
+        extend = numpy.zeros(shape, dtype=bool)
+        ac = numpy.zeros(shape, dtype=bool)
+        if node_type == type_c:
+            score, direction, left_score = self._row(i - 1)
+            left, extend = open_extend(score[..., here], left_score[..., here], direction[..., here],
+                                       self.gaps1[i-1], self.gapopen, 1)
+        elif node_type == type_t:
+            paired = self.paired1[i-1]
+            gap_row = 0 if paired == -1 else paired
+            major = self.major1[i-1]
+            score, direction, left_score = self._row(gap_row)
+            left, extend = open_extend(score[..., here], left_score[..., here], direction[..., here],
+                                       major + self.gaps1[gap_row], self.gapopen, 1)
+            if paired != -1:
+                # The paired A may instead be matched to a C in sequence 2
+                prior = score[..., prior_cols]
+                ac_score = prior + major + self.match_row(gap_row + 1)[..., prior_cols] + self.gapopen
+                ac = ((types2 == type_c) & (prior != neg_inf)
+                      & ((left == neg_inf) | (ac_score >= left)))
+                left = numpy.where(ac, ac_score, left)
+                extend = extend & ~ac
+        return left, extend, ac
+
+    def _fill_row(self, i, up_columns):
+        '''
+        Computes row i from the rows before it.
+        @return: score, direction, left-gap (score, extend, A-C match) and
+        up-gap (score, extend, A-C match) arrays, each including column 0.
+        '''
+        l2 = len(self.types2)
+        node_type = self.types1[i-1]
+        prior_row = self._row(i - 1)[0]
+        first, last = 1, l2
+        prior_first = 0 # first filled column of the prior row
+        if self.band_lo is not None:
+            # Only the cells within the band are computed, the rest are unreachable
+            first, last = max(self.band_lo[i], 1), self.band_hi[i]
+            prior_first = self.band_lo[i-1]
+        # Nodes only match nodes of the same type, and only from reachable cells
+        prior = prior_row[first-1:last]
+        match = prior + self.match_row(i)[first-1:last]
+        match[(self.types2[first-1:last] != node_type) | (prior == neg_inf)] = neg_inf
+
+        left_score = numpy.full(l2 + 1, neg_inf)
+        left_extend = numpy.zeros(l2 + 1, dtype=bool)
+        left_ac = numpy.zeros(l2 + 1, dtype=bool)
+        if self.allow_left:
+            left_score[first:last+1], left_extend[first:last+1], left_ac[first:last+1] = \
+                self._left_gap(i, first, last)
+
+        # Only the filled columns are converted, the rest are unreachable
+        match = [neg_inf] * (first - 1) + match.tolist()
+        left = [neg_inf] * first + left_score[first:last+1].tolist()
+        score = [self._border1[i]] + [neg_inf] * l2
+        direction = [0] * (l2 + 1)
+        up_score = [neg_inf] * (l2 + 1)
+        up_extend = [False] * (l2 + 1)
+        up_ac = [False] * (l2 + 1)
+        allow_up = self.allow_up
+        gapopen = self.gapopen
+        if allow_up:
+            types2, paired2, major2, source, cost = up_columns
+            prior = [neg_inf] * prior_first + prior_row[prior_first:last].tolist()
+            ac_up = [neg_inf] * prior_first + self.ac_up_row(i)[prior_first:last].tolist()
+            row_is_c = node_type == type_c
+
+        for j in range(first, last + 1):
+            up = neg_inf
+            if allow_up and types2[j-1] != type_a:
+                # Determine whether the up-gap opens or extends a gap
+                k = source[j-1]
+                m = score[k]
+                extend = False
+                if m != neg_inf:
+                    up = m + cost[j-1]
+                    if up_score[k] == neg_inf: # Previous position can't gap
+                        up += gapopen
+                    elif direction[k] != 2: # Previous position didn't choose gap
+                        extend_up = up_score[k] + cost[j-1]
+                        if up + gapopen >= extend_up:
+                            up += gapopen
+                        else:
+                            up = extend_up
+                            extend = True
+                    else: # Previous position did choose gap
+                        extend = True
+                if types2[j-1] == type_t and row_is_c and paired2[j-1] != -1:
+                    # Determine whether to match the T-paired A with this C
+                    if prior[k] != neg_inf:
+                        ac_score = prior[k] + major2[j-1] + ac_up[k] + gapopen
+                        if up == neg_inf or ac_score >= up:
+                            up = ac_score
+                            extend = False
+                            up_ac[j] = True
+                up_score[j] = up
+                up_extend[j] = extend
+
+            s, lf = match[j-1], left[j]
+            if s != neg_inf and (lf == neg_inf or s >= lf) and (up == neg_inf or s >= up):
+                score[j] = s
+            elif lf != neg_inf and (up == neg_inf or lf >= up):
+                score[j] = lf
+                direction[j] = 1
+            elif up != neg_inf:
+                score[j] = up
+                direction[j] = 2
+            else:
+                # This location is unreachable due to presence of a composite sequence
+                score[j] = neg_inf
+
+        fill = lambda values, blank, dtype: _row_array(values, first, last, blank, dtype)
+        return (fill(score, neg_inf, float), fill(direction, 0, numpy.int8), left_score,
+                left_extend, left_ac, fill(up_score, neg_inf, float), fill(up_extend, False, bool),
+                fill(up_ac, False, bool))
+
+    def _through_bound(self, r, cols):
+        '''
+        Upper bound of the score of any path through cells (r, cols), from
+        the composition of the nodes aligned before and after them: every
+        node is gapped at its cheapest, plus the gain of each matched pair.
+        The pairs matched before a cell take at most as much gain as either
+        prefix has, and those after it as either suffix has; T-nodes only
+        match T-nodes, so their gains are bounded apart from the others.
+        '''
+        gaps1, gaps2, gains1, gains2 = self.bounds
+        if self._gain_sums is None:
+            cumulative = lambda gains, types: numpy.concatenate(
+                ([[0], [0]], numpy.cumsum([numpy.where(types == type_t, gains, 0),
+                                           numpy.where(types != type_t, gains, 0)], axis=1)), axis=1)
+            self._gain_sums = (cumulative(gains1, self.types1), cumulative(gains2, self.types2))
+        sums1, sums2 = self._gain_sums
+        before1, before2 = sums1[:, r, None], sums2[:, cols]
+        after1, after2 = sums1[:, -1, None] - before1, sums2[:, -1, None] - before2
+        bound = gaps1.sum() + gaps2.sum() + (numpy.minimum(before1, before2) +
+                                             numpy.minimum(after1, after2)).sum(axis=0)
+        if self.gapopen > 0: # at most one gap opening per gapped node
+            bound += (len(gaps1) + len(gaps2)) * self.gapopen
+        return bound
+
+    def _band_needed(self, score):
+        '''
+        The narrowest band outside of which no cell lies on a path that could
+        score score or more, by _through_bound. A subtree gap out of the band
+        passes the cell it jumps back to, so is covered too.
+        '''
+        l1, l2 = len(self.types1), len(self.types2)
+        center = (numpy.arange(l1 + 1) * l2 + l1 // 2) // l1
+        cols = numpy.arange(l2 + 1)
+        needed = 0
+        for r in range(l1 + 1):
+            reach = numpy.flatnonzero(self._through_bound(r, cols) >= score)
+            if len(reach):
+                needed = max(needed, center[r] - reach[0], reach[-1] - center[r])
+        return int(needed)
+
+    def fit_band(self, band):
+        '''
+        Fills only the cells within band of the diagonal, and while a path
+        out of the band could still score as high as the score found
+        (_band_needed), doubles the band, up to what is needed, and fills
+        again; so the optimal alignment lies within the final band. Once the
+        band spans half the matrix or more, the whole matrix is filled as by
+        fill() without a band, which costs little more.
+        @return: self, filled with the final band.
+        '''
+        l1, l2 = len(self.types1), len(self.types2)
+        width = max(l1, l2)
+        while l1 and l2 and 2 * band < width:
+            self.set_band(band)
+            self.fill()
+            needed = width if self.top_score is None else self._band_needed(self.top_score)
+            if needed <= band:
+                return self
+            band = min(max(2 * band, 1), needed)
+        self.set_band(None)
+        return self.fill()
+
+    def traceback(self, seq1, seq2, forced_up_ac=True, flags=None):
+        '''
+        Walks back from the bottom-right cell, producing the aligned strings.
+        The backtrace position of a T-node gap is recovered from the paired A
+        and the A-C match flag rather than stored per cell.
+        @param forced_up_ac: whether a forced (extended) up-gap over a T-node
+        honours the A-C match flag; NeedlemanWunsch always gaps the A.
+        @param flags: callable giving the traceback flags of a row, as kept by
+        _advance; defaults to the full matrices.
+        '''
+        if flags is None:
+            flags = lambda i: (self.direction[i], self.left_extend[i], self.left_ac[i],
+                               self.up_extend[i], self.up_ac[i])
+        types1, types2 = self.types1.tolist(), self.types2.tolist()
+        paired1, paired2 = self.paired1.tolist(), self.paired2.tolist()
+        align1, align2 = [], []
+        i, j = len(seq1), len(seq2)
+        keep_gapping = 0
+        while i > 0 and j > 0: # walk-back to the index [0][0] of the m
+            next_i, next_j = i, j
+            direction, left_extend, left_ac, up_extend, up_ac = flags(i)
+            # if score is a gap in sequence 2 (direction is 1), only walk back on i
+            if keep_gapping == 1 or keep_gapping == 0 and direction[j] == 1:
+                # If the node being gapped is a T-node, gap the entire subtree
+                if types1[i-1] == type_t:
+                    if keep_gapping == 1:
+                        i_target = paired1[i-1]
+                    else:
+                        i_target = 0 if paired1[i-1] == -1 else paired1[i-1]
+                    j_target = j - 1 if left_ac[j] else j
+                    while next_i > i_target + 1:
+                        align1.append(seq1[next_i-1])
+                        align2.append('-')
+                        next_i -= 1
+                    # the gap is preceeded either by an A-C match or a gapped A
+                    if j_target < next_j:
+                        align1.append(seq1[next_i-1])
+                        align2.append(seq2[next_j-1])
+                        next_i -= 1
+                        next_j -= 1
+                    else:
+                        align1.append(seq1[next_i-1])
+                        align2.append('-')
+                        next_i -= 1
+                else: # otherwise just gap the current node (it will be a C-node)
+                    align1.append(seq1[next_i-1])
+                    align2.append('-')
+                    next_i -= 1
+                keep_gapping = 1 if left_extend[j] else 0
+
+            # if score is a gap in sequence 1 (direction is 2), only walk back on j
+            elif keep_gapping == 2 or keep_gapping == 0 and direction[j] == 2:
+                if types2[j-1] == type_t:
+                    if keep_gapping == 2:
+                        j_target = paired2[j-1]
+                    else:
+                        j_target = 0 if paired2[j-1] == -1 else paired2[j-1]
+                    i_target = i - 1 if up_ac[j] else i
+                    honour_ac = forced_up_ac or keep_gapping != 2
+                    while next_j > j_target + 1:
+                        align1.append('-')
+                        align2.append(seq2[next_j-1])
+                        next_j -= 1
+                    if honour_ac and i_target < next_i:
+                        align1.append(seq1[next_i-1])
+                        align2.append(seq2[next_j-1])
+                        next_i -= 1
+                        next_j -= 1
+                    else:
+                        align1.append('-')
+                        align2.append(seq2[next_j-1])
+                        next_j -= 1
+                else:
+                    align1.append('-')
+                    align2.append(seq2[next_j-1])
+                    next_j -= 1
+                keep_gapping = 2 if up_extend[j] else 0
+
+            # if the score is a match, walk-back one index in both i and j
+            elif direction[j] == 0:
+                keep_gapping = 0
+                align1.append(seq1[i-1])
+                align2.append(seq2[j-1])
+                next_i -= 1
+                next_j -= 1
+            i, j = next_i, next_j
+
+        # walk-back to index 0 for both i and j; either could be reached first
+        while i > 0:
+            align1.append(seq1[i-1])
+            align2.append('-')
+            i -= 1
+        while j > 0:
+            align1.append('-')
+            align2.append(seq2[j-1])
+            j -= 1
+        # Reverse the alignment strings as they are assembled backwards
+        return ''.join(reversed(align1)), ''.join(reversed(align2))
+
+    def linear_traceback(self, seq1, seq2, forced_up_ac=True, block_rows=64):
+        '''
+        Traceback without the full matrices. Rows are split in half
+        recursively: the fill is run forward to the midpoint to checkpoint its
+        live rows, the lower half is traced first, then the upper half is
+        resumed from its checkpoint. Only segments of at most block_rows rows
+        are ever held in full, so memory is linear in the sequence lengths
+        (plus the rows before open subtrees, which T-node gaps jump back to).
+        The traceback only moves up, so each segment is filled at most once
+        per level, and the result is identical to traceback().
+        @return: aligned strings of sequence 1 and 2.
+        '''
+        l1 = len(self.types1)
+        if l1 == 0 or len(self.types2) == 0:
+            self.fill()
+            return self.traceback(seq1, seq2, forced_up_ac)
+        segments = [(self._first_rows(), 0, l1)] # rows live after a, rows a+1..b pending
+        block = {}
+
+        def flags(i):
+            if i in block:
+                return block[i]
+            block.clear()
+            while True:
+                rows, start, stop = segments[-1]
+                if i <= start: # segment lies entirely below the traceback
+                    segments.pop()
+                elif stop - start <= block_rows:
+                    segments.pop()
+                    self._advance(rows, start, stop, block)
+                    if stop == l1:
+                        score = self.rows[l1][0][-1]
+                        self.top_score = None if score == neg_inf else score
+                    return block[i]
+                else:
+                    mid = (start + stop) // 2
+                    segments[-1] = (rows, start, mid)
+                    segments.append((self._advance(rows, start, mid), mid, stop))
+
+        alignment = self.traceback(seq1, seq2, forced_up_ac, flags)
+        self.rows = None
+        return alignment
+
+class BatchAlignmentKernel(TreeAlignmentKernel):
+    '''
+    TreeAlignmentKernel aligning one sequence 1 against a batch of sequence
+    2s at once. Each row holds a (batch, columns) array, the queries padded
+    to the longest with untyped nodes which match nothing; as cells only
+    depend on cells to their left and above, the padding never reaches the
+    cells of a shorter query. The up-gap recurrence is resolved column by
+    column across the whole batch. The same operations as _fill_row are
+    applied in the same order, so each query's scores and alignment are
+    those of its own TreeAlignmentKernel.
+
+    @param types2, gaps2, paired2, major2: (batch, columns) arrays, padded.
+    @param match_row, ac_up_row: callables returning (batch, columns) arrays.
+    @param border2: (batch, columns + 1) array of first-row scores.
+    @param lengths2: length of each sequence 2.
+    '''
+    def __init__(self, types1, types2, gaps1, gaps2, paired1, paired2,
+                 major1, major2, match_row, ac_up_row, border1, border2, lengths2,
+                 gapopen, allow_left=True, allow_up=True, score_only=False):
+        super(BatchAlignmentKernel, self).__init__(types1, types2, gaps1, gaps2, paired1, paired2,
+                                                   major1, major2, match_row, ac_up_row, border1,
+                                                   border2, gapopen, allow_left, allow_up,
+                                                   score_only, wavefront=False)
+        self.lengths2 = lengths2
+        self.top_scores = None # score of each query, None where unreachable
+
+    @staticmethod
+    def pad(arrays, fill, dtype):
+        '''
+        Stacks the per-query arrays of a batch, padded to the longest with fill.
+        '''
+        batch = numpy.full((len(arrays), max(len(a) for a in arrays)), fill, dtype=dtype)
+        for b, a in enumerate(arrays):
+            batch[b, :len(a)] = a
+        return batch
+
+    def fill(self):
+        l1 = len(self.types1)
+        batch, l2 = self.types2.shape
+        if self.score_only:
+            self.rows = self._advance(self._first_rows(), 0, l1)
+        else:
+            shape = (l1+1, batch, l2+1)
+            self.score = numpy.zeros(shape)
+            self.direction = numpy.zeros(shape, dtype=numpy.int8)
+            self.left_score = numpy.zeros(shape)
+            self.left_extend = numpy.zeros(shape, dtype=bool)
+            self.left_ac = numpy.zeros(shape, dtype=bool)
+            self.up_score = numpy.zeros(shape)
+            self.up_extend = numpy.zeros(shape, dtype=bool)
+            self.up_ac = numpy.zeros(shape, dtype=bool)
+            self.score[:, :, 0] = self.border1[:, None]
+            self.score[0] = self.border2
+            for m in (self.left_score, self.up_score):
+                m[1:, :, 0] = neg_inf
+                m[0, :, 1:] = neg_inf
+            up_columns = self._up_columns()
+            for i in range(1, l1 + 1):
+                row = self._fill_row(i, up_columns)
+                (self.score[i, :, 1:], self.direction[i, :, 1:], self.left_score[i, :, 1:],
+                 self.left_extend[i, :, 1:], self.left_ac[i, :, 1:], self.up_score[i, :, 1:],
+                 self.up_extend[i, :, 1:], self.up_ac[i, :, 1:]) = [r[:, 1:] for r in row]
+        scores = self._row(l1)[0][numpy.arange(batch), self.lengths2].tolist()
+        self.top_scores = [None if score == neg_inf else score for score in scores]
+        return self
+
+    def _up_columns(self):
+        '''
+        Per-column constants of the up-gap recurrence, as (columns, batch)
+        arrays so each column is contiguous: the column each gap comes from,
+        its cost, whether the node can be gapped, whether the paired A may
+        be matched instead, and the cost of the paired subtree.
+        '''
+        batch, l2 = self.types2.shape
+        is_t = self.types2 == type_t
+        pos = numpy.where(self.paired2 == -1, 0, self.paired2)
+        source = numpy.where(is_t, pos, numpy.arange(l2))
+        cost = numpy.where(is_t, self.major2 + numpy.take_along_axis(self.gaps2, pos, 1), self.gaps2)
+        columns = (source, cost, self.types2 != type_a, is_t & (self.paired2 != -1), self.major2)
+        return [numpy.ascontiguousarray(c.T) for c in columns]
+
+    def _fill_row(self, i, up_columns):
+        '''
+        Computes row i of every query from the rows before it. The up-gap
+        recurrence runs over columns of (columns, batch) arrays, gathering
+        the cell each gap comes from by its flat index.
+        @return: as TreeAlignmentKernel._fill_row, with (batch, columns + 1) arrays.
+        '''
+        batch, l2 = self.types2.shape
+        node_type = self.types1[i-1]
+        prior_row = self._row(i - 1)[0]
+        # Nodes only match nodes of the same type, and only from reachable cells
+        prior = prior_row[:, :-1]
+        match = prior + self.match_row(i)
+        match[(self.types2 != node_type) | (prior == neg_inf)] = neg_inf
+
+        shape = (batch, l2 + 1)
+        left_score = numpy.full(shape, neg_inf)
+        left_extend = numpy.zeros(shape, dtype=bool)
+        left_ac = numpy.zeros(shape, dtype=bool)
+        if self.allow_left:
+            left_score[:, 1:], left_extend[:, 1:], left_ac[:, 1:] = self._left_gap(i)
+
+        match = numpy.ascontiguousarray(match.T)
+        left = numpy.ascontiguousarray(left_score.T)
+        score = numpy.full((l2 + 1, batch), neg_inf)
+        score[0] = self.border1[i]
+        direction = numpy.zeros((l2 + 1, batch), dtype=numpy.int8)
+        up_score = numpy.full((l2 + 1, batch), neg_inf)
+        up_extend = numpy.zeros((l2 + 1, batch), dtype=bool)
+        up_ac = numpy.zeros((l2 + 1, batch), dtype=bool)
+        up = numpy.full(batch, neg_inf)
+        if self.allow_up:
+            source, cost, gapped, ac_columns, major = up_columns
+            queries = numpy.arange(batch)
+            flat_score, flat_up, flat_direction = score.reshape(-1), up_score.reshape(-1), direction.reshape(-1)
+            prior = numpy.ascontiguousarray(prior_row.T).reshape(-1)
+            ac_up = numpy.ascontiguousarray(self.ac_up_row(i).T).reshape(-1)
+            row_is_c = node_type == type_c
+
+        for j in range(1, l2 + 1):
+            if self.allow_up:
+                # Determine whether the up-gap opens or extends a gap
+                cell = source[j-1] * batch + queries
+                up, extend = open_extend(flat_score[cell], flat_up[cell], flat_direction[cell],
+                                         cost[j-1], self.gapopen, 2)
+                up[~gapped[j-1]] = neg_inf
+                extend &= gapped[j-1]
+                if row_is_c:
+                    # Determine whether to match the T-paired A with this C
+                    prior_k = prior[cell]
+                    ac_score = prior_k + major[j-1] + ac_up[cell] + self.gapopen
+                    ac = (ac_columns[j-1] & (prior_k != neg_inf)
+                          & ((up == neg_inf) | (ac_score >= up)))
+                    up = numpy.where(ac, ac_score, up)
+                    extend &= ~ac
+                    up_ac[j] = ac
+                up_score[j] = up
+                up_extend[j] = extend
+
+            # As in _fill_row, where a reachable score beats any -inf
+            s, lf = match[j-1], left[j]
+            is_match = (s != neg_inf) & (s >= lf) & (s >= up)
+            is_left = ~is_match & (lf != neg_inf) & (lf >= up)
+            is_up = ~is_match & ~is_left & (up != neg_inf)
+            score[j] = numpy.where(is_match, s, numpy.where(is_left, lf, up))
+            direction[j] = is_left + 2 * is_up
+
+        return (score.T, direction.T, left_score, left_extend, left_ac, up_score.T,
+                up_extend.T, up_ac.T)
+
+    def query_traceback(self, b, seq1, seq2, forced_up_ac=True):
+        '''
+        Traceback of query b of the batch from the full matrices.
+        @return: aligned strings of sequence 1 and query b.
+        '''
+        query = copy.copy(self)
+        query.types2, query.paired2 = self.types2[b], self.paired2[b]
+        flags = lambda i: (self.direction[i, b], self.left_extend[i, b], self.left_ac[i, b],
+                           self.up_extend[i, b], self.up_ac[i, b])
+        return TreeAlignmentKernel.traceback(query, seq1, seq2, forced_up_ac, flags)
@@ -393,6 +393,56 @@ class DirectionalMatrixWrapper():
     def transpose(self):
         return self.T
 
+class ArrayStateMatrix():
+    '''
+    A StateMatrix whose contents are held in a typed NumPy array. Cells equal
+    to the null value (e.g. -inf for unreachable scores) are reported as None,
+    and other values are converted back to python numbers by cast.
+    '''
+    def __init__(self, data, null=None, cast=None, T=None):
+        self.data = data
+        self.nrows, self.ncols = data.shape
+        self.null = null
+        self.cast = cast
+        if T is None:
+            self.T = ArrayStateMatrix(data.T, null, cast, self)
+        else:
+            self.T = T
+
+    def get_data(self, i, j):
+        val = self.data[i, j]
+        if self.null is not None and val == self.null:
+            return None
+        if self.cast is not None:
+            return self.cast(val)
+        return val.item()
+
+    def set_data(self, i, j, val):
+        self.data[i, j] = self.null if val is None else val
+
+    def transpose(self):
+        return self.T
+
+class ArrayDirectionalMatrixWrapper():
+    '''
+    A wrapper for directional score matrices held in NumPy arrays.
+    '''
+    def __init__(self, score, extend_flag, a_c_match, T=None):
+        self.nrows, self.ncols = score.shape
+        if T is None:
+            self.score = ArrayStateMatrix(score, null=float('-inf'))
+            self.extend_flag = ArrayStateMatrix(extend_flag)
+            self.a_c_match = ArrayStateMatrix(a_c_match)
+            self.T = ArrayDirectionalMatrixWrapper(score.T, extend_flag.T, a_c_match.T, self)
+        else:
+            self.T = T
+            self.score = T.score.T
+            self.extend_flag = T.extend_flag.T
+            self.a_c_match = T.a_c_match.T
+
+    def transpose(self):
+        return self.T
+
 def factorial(num):
     """
     Computes the factorial for a given integer. To enable factorial
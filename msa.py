@@ -1,6 +1,7 @@
-from pairwise import NeedlemanWunsch, PositionWeightedMatcher
+from pairwise import NeedlemanWunsch, PositionWeightedMatcher, aligners, matchers, align_pair
 import math
-from sequence import NeuriteSequence
+import numpy
+from sequence import NeuriteSequence, collapse_duplicates
 import concurrent.futures
 import sequence
 from collections import Counter
@@ -18,15 +19,32 @@ class MultipleSequenceDriver():
         self.queries = queries
         self.costs = input_state.get_penalties() # set costs to core
         self.submat = input_state.get_submatrix() # set submatrix to core
+        self.scoring = input_state.get_scoring_scheme() # compiled costs and submatrix
         self.iterate = input_state.get_args()['iterate']
         self.composite = None # initially, no composite exists
         self.composite_score = 0
         self.alignment_file = input_state.alignment_file
+        # Alignment of each query (None if it failed), filled by query index
         self.alns = []
+        self.aln_weights = [] # number of queries each alignment stands for; 0 for those aligned as another
+        self.aln_scores = [] # score of each alignment against the pwm
+        self.column_counts = None # ColumnCounts of the alignments, updated as they arrive
+        # With a refinement tolerance, only queries whose aligned columns changed weight by more than
+        # this share of the number of queries are realigned on later iterations
+        self.refine_tol = None
+        if 'refine_tol' in input_state.get_args().keys() and input_state.get_args()['refine_tol'] is not None:
+            self.refine_tol = input_state.get_args()['refine_tol']
+        self.realigned = [] # number of unique queries aligned at each iteration
+        # In debug mode the matchers, with their full matrices, are kept: query index => matcher
+        self.debug = 'msa_debug' in input_state.get_args().keys() and input_state.get_args()['msa_debug']
+        self.matchers = {}
         self.pwm = None
         self.node_types = input_state.node_types
         self.consensus_check_percent = .4
         self.num_workers = input_state.get_args()['n']
+        self.engine_type = input_state.get_engine()
+        self.engine_options = input_state.get_engine_options()
+        self.cache = input_state.get_alignment_cache()
 
         self.composite_alignments = []
 
@@ -44,10 +62,9 @@ class MultipleSequenceDriver():
         s0 = queries[0]
         s1 = queries[1]
         # pass them both into the tree--based Needleman--Wunsch algorithm.
-        nw = NeedlemanWunsch(s1=s0, s2=s1, costs=self.costs, submat=self.submat, 
-                                       node_types=self.node_types)
-        first_align, second_align = nw.prettify()[1]
-        self.composite_alignments.append([nw.align1,nw.align2])
+        first_align, second_align = align_pair(s0, s1, self.scoring, self.engine_type,
+                                               self.engine_options, self.cache)[1]
+        self.composite_alignments.append([first_align, second_align])
         
         # feed respective alignments into an analysis class and get consensus.
         composite = TreeLogicFactory(str1=first_align, 
@@ -60,11 +77,8 @@ class MultipleSequenceDriver():
         # since the first two sequences have been aligned, focus on all others.
         for i in range(2, len(queries)):
             curr_seq = queries[i]
-            nw = NeedlemanWunsch(s1=composite, s2=curr_seq, 
-                                         costs=self.costs, submat=self.submat, 
-                                         node_types=self.node_types)
-
-            align_sA, align_sB = nw.get_alignment()
+            align_sA, align_sB = align_pair(composite, curr_seq, self.scoring, self.engine_type,
+                                            self.engine_options, self.cache)[1]
 
             self.composite_alignments.append([align_sA,align_sB])
             #print(align_sA)
@@ -96,8 +110,19 @@ class MultipleSequenceDriver():
         if iterate < 1:
             iterate_count = 1 # Iterate until %change is within the iterate threshold given in iterate
 
+        # Identical queries are aligned once, their alignment weighted by their number
+        representatives = collapse_duplicates(self.queries)
+        multiplicity = Counter(representatives)
+        if len(multiplicity) < len(self.queries):
+            print('Aligning ' + str(len(multiplicity)) + ' unique of ' + str(len(self.queries)) + ' queries')
+
         # Initialize pwm with equal weights per position
-        pwm = PositionWeightedMatrix(self.composite,list([{'total':1,char:1} for char in self.composite.seq]))
+        composite_counts = ColumnCounts(len(self.composite.seq))
+        composite_counts.add(self.composite.seq)
+        pwm = composite_counts.get_pwm(self.composite, self.node_types)
+        prev_totals = None # column weights of the pwm of the previous iteration
+        aligned_totals = [None] * len(self.queries) # per query, those of the pwm it was last aligned to
+        self.realigned = []
 
         continue_iter = True
         iter_count = 0
@@ -110,29 +135,63 @@ class MultipleSequenceDriver():
             iter_count += 1
 
 #        for curr_it in range(iterate_count):
-            self.alns = [] # New alignments at each iteration, final iteration gives final alignment
-            executor = concurrent.futures.ProcessPoolExecutor(self.num_workers)
+            prev_alns, prev_scores = self.alns, self.aln_scores
+            # New alignments at each iteration, final iteration gives final alignment
+            self.alns = [None] * len(self.queries)
+            self.aln_weights = [0] * len(self.queries)
+            self.aln_scores = [None] * len(self.queries)
+            self.column_counts = ColumnCounts(len(self.composite.seq))
+            self.matchers = {}
+            # Get name lengths for position aligning names in alignment file output
+            if iterate is None or iter_count == iterate-1:
+                name_lengths.extend(len(curr_seq.name) for curr_seq in self.queries)
+
+            # A query keeps its previous alignment, rescored against the new pwm, unless a column
+            # it is aligned to changed weight by more than the tolerance since it was aligned
+            realign = list(multiplicity)
+            if self.refine_tol is not None and prev_totals is not None:
+                realign = []
+                for index in multiplicity:
+                    if prev_alns[index] is None:
+                        realign.append(index)
+                        continue
+                    aligned = sequence.encode_residues(prev_alns[index]) != ord('-')
+                    if (numpy.abs(pwm.totals - aligned_totals[index])[aligned] > self.refine_tol * len(self.queries)).any():
+                        realign.append(index)
+                    else:
+                        cast = int if pwm.integral else float
+                        score = prev_scores[index] + cast((pwm.totals - prev_totals)[aligned].sum())
+                        self._store_alignment(index, multiplicity[index], prev_alns[index], score)
+                print("MSA Iteration "+str(iter_count)+": realigning "+str(len(realign))+" of "+str(len(multiplicity))+" queries")
+            self.realigned.append(len(realign))
+            for index in realign:
+                aligned_totals[index] = pwm.totals
+            prev_totals = pwm.totals
+            executor = concurrent.futures.ProcessPoolExecutor(self.num_workers, initializer=_init_matcher,
+                                                              initargs=(pwm, self.costs, self.node_types, self.scoring,
+                                                                        self.engine_type, self.engine_options, self.debug))
             try:
-                # Align each query with composite
-                for curr_seq in self.queries:
-                    # Get name lengths for position aligning names in alignment file output
-                    if iterate is None or iter_count == iterate-1:
-                        name_lengths.append(len(curr_seq.name))
-
+                # Align each unique query with composite, longest first so that the workers finish
+                # together; results are stored by query index, whatever order they complete in
+                for index in sorted(realign, key=lambda index: (-len(self.queries[index].seq), index)):
+                    curr_seq = self.queries[index]
                     # Setting 'consensus=2' tells NW that s2 is the consensus and will prevent gaps from appearing in s1 alignemtn
 
                     #pw_matcher = PositionWeightedMatcher(sequence=curr_seq, pwm=pwm, 
                     #                    costs=self.costs, node_types=self.node_types)
 
-                    f = executor.submit(PositionWeightedMatcher,sequence=curr_seq, pwm=pwm, 
-                                        costs=self.costs, node_types=self.node_types)
-                    f.add_done_callback(self._msa_callback)
+                    f = executor.submit(_match_query, index, curr_seq)
+                    f.add_done_callback(lambda f, index=index: self._msa_callback(multiplicity[index], f))
                 executor.shutdown()
             except KeyboardInterrupt:
                 executor.shutdown()
                 print("MSA Iteration interupted, stopping program")
                 change = iterate + 1
                 iter_count = iterate
+            # Identical queries share the alignment of their representative
+            for index, representative in enumerate(representatives):
+                self.alns[index] = self.alns[representative]
+                self.aln_scores[index] = self.aln_scores[representative]
 
             # Get the PWM given the alignments for the next iteration
             pwm = self.get_pwm()
@@ -150,38 +209,41 @@ class MultipleSequenceDriver():
             total_space = max(12,max(name_lengths))+1
             align_handle.write(('Composite'+' '*(total_space-12))+self.composite.seq+'\n') # write header
             for index,curr_seq in enumerate(self.queries):
-                align_handle.write(curr_seq.name+(' '*(total_space-len(curr_seq.name)))+(''.join(self.alns[index]))+'\n') # write header
+                alignment = self.alns[index]
+                align_handle.write(curr_seq.name+(' '*(total_space-len(curr_seq.name)))+(''.join(alignment))+'\n') # write header
             align_handle.close()
 
-    def _msa_callback(self, return_val):
+    def _msa_callback(self, weight, return_val):
         cbexcept = return_val.exception()
         if cbexcept is not None:
             print("Error: "+str(cbexcept))
-        pw_matcher = return_val.result()
-        align_sA = pw_matcher.get_alignment()[0]
-        self.alns.append(align_sA)
+            return
+        result = return_val.result()
+        index, align_sA, score = result[:3]
+        self._store_alignment(index, weight, align_sA, score)
+        if self.debug:
+            self.matchers[index] = result[3]
+
+    def _store_alignment(self, index, weight, alignment, score):
+        '''
+        Stores the alignment of a query and its score, and counts its columns weight times.
+        '''
+        self.alns[index] = alignment
+        self.aln_weights[index] = weight
+        self.aln_scores[index] = score
+        self.column_counts.add(alignment, weight)
 
         
 
     # Generate a position weighted matrix of the form: array of {character:weight}
     def get_pwm(self):        
         # Determine composite score now that alignments exist, and generate pwm
-        col_counts = []
-        composite_count = 0
         height = len(self.queries)
-
-        for col_num in range(len(self.composite.seq)): # process each column
-            char_counts = self.enumerate_column(col_num)
-            col_counts.append(char_counts)
-            if '-' in char_counts:
-                count_base = height - char_counts['-']
-            else:
-                count_base = height
-            composite_count += count_base
+        composite_count = (height - self.column_counts.gaps()).sum()
         self.composite_score = float(composite_count)/height/len(self.composite.seq)
 
         composite_node_types = NeuriteSequence('PWM Node Types',''.join(list([self.node_types[char] for char in self.composite.seq])))
-        self.pwm = PositionWeightedMatrix(composite_node_types,col_counts)
+        self.pwm = self.column_counts.get_pwm(composite_node_types, self.node_types)
 
         return self.pwm
 
@@ -191,7 +253,9 @@ class MultipleSequenceDriver():
         value is found in that respective column.
         '''
 
-        char_counts = dict(Counter(''.join(aln[num] for aln in self.alns)))
+        # each alignment counts for the queries it stands for
+        column = self.column_counts.counts[num]
+        char_counts = {chr(code): int(column[code]) for code in numpy.flatnonzero(column).tolist()}
 
 #        a_column = [] # stores values for a single column
 #        for row_num in range(len(self.alns)):            
@@ -214,7 +278,7 @@ class MultipleSequenceDriver():
         if len(self.alns) == 0:
             self.align()
 
-        height = len(self.alns) # number of entries comprising alignment
+        height = self.column_counts.height # number of entries comprising alignment
         width = len(self.composite.seq) # all alignments are the same length
 
         if threshold_type == 'sqrt':
@@ -278,7 +342,7 @@ class MultipleSequenceDriver():
                 for alignment_ind in range(len(self.alns)):
                     #print(str(alignment_ind)+' '+str(self.composite_alignments[max(alignment_ind-1,0)][0])+'\n'+str(self.composite_alignments[max(alignment_ind-1,0)][1]))
                     alignment = self.alns[alignment_ind]
-                    if (alignment[col_num] == 'T') ^ composite_is_t:
+                    if alignment is not None and (alignment[col_num] == 'T') ^ composite_is_t:
                         offender = alignment
                         offender_ind = alignment_ind
                         print('offender index: '+str(offender_ind))
@@ -311,17 +375,102 @@ class MultipleSequenceDriver():
         return consensus_object
         
 
+# Data a worker process shares across the queries of an iteration, set by _init_matcher
+_matcher_state = {}
+
+def _init_matcher(pwm, costs, node_types, scoring, engine_type, engine_options, debug=False):
+    '''
+    Loads the pwm of an iteration and the alignment parameters into a worker process once.
+    '''
+    _matcher_state.update(pwm=pwm, costs=costs, node_types=node_types, scoring=scoring,
+                          engine_type=engine_type, engine_options=engine_options, debug=debug)
+
+def _match_query(index, query):
+    '''
+    Aligns a query to the pwm of the worker process.
+    @return: the query index, its aligned string and its score; in debug
+    mode followed by the matcher, with its full matrices.
+    '''
+    state = _matcher_state
+    pw_matcher = matchers[state['engine_type']](sequence=query, pwm=state['pwm'], costs=state['costs'],
+                                                node_types=state['node_types'], scoring=state['scoring'],
+                                                **state['engine_options'])
+    result = (index, pw_matcher.get_alignment()[0], pw_matcher.get_top_score())
+    if state['debug']:
+        return result + (pw_matcher,)
+    return result
+
+class ColumnCounts():
+    '''
+    Running counts of the characters at each position of equal length
+    alignments, updated as each alignment arrives. Characters are counted by
+    residue code, in a position by residue code integer array.
+    @param width: length of the alignments.
+    '''
+    def __init__(self, width):
+        self.counts = numpy.zeros((width, 256), dtype=numpy.int64)
+        self.positions = numpy.arange(width)
+        self.height = 0 # number of alignments counted
+
+    def add(self, alignment, weight=1):
+        '''
+        Counts an alignment string weight times.
+        '''
+        self.counts[self.positions, sequence.encode_residues(alignment)] += weight
+        self.height += weight
+
+    def gaps(self):
+        '''
+        @return: gap count per position.
+        '''
+        return self.counts[:, ord('-')]
+
+    def get_pwm(self, node_type_sequence, node_types=sequence.default_nodetypes):
+        '''
+        Creates the position weighted matrix of the counts.
+        @param node_type_sequence: NeuriteSequence of the node type of each position.
+        @param node_types: dictionary of node type to residue characters.
+        @return: PositionWeightedMatrix.
+        '''
+        present = self.counts.any(axis=0)
+        present[ord('-')] = False
+        codes = numpy.flatnonzero(present)
+        residues = ''.join(chr(code) for code in codes.tolist())
+        return PositionWeightedMatrix(node_type_sequence, residues, self.counts[:, codes], self.gaps(), node_types)
+
 class PositionWeightedMatrix():
     '''
-    Contains a string of node types (A,C,T) along with an array of dictionaries giving the weight of a position and
-    an associated character.
+    Contains a string of node types (A,C,T) along with the weight of each character at each position. The
+    weights are compiled for the matcher into a dense position by residue array, whose residue columns are
+    found by residue code through index (residues weighted nowhere index a last column of zeros), along
+    with the total residue weight and the node type code of each position. pwm holds the same weights as
+    an array of dictionaries of character to weight, with the gap weight under '-' and the total under 'total'.
+    @param node_type_sequence: NeuriteSequence of the node type of each position.
+    @param residues: string of the residues weighted.
+    @param weights: position by residue array of weights, in the order of residues.
+    @param gaps: gap weight per position.
+    @param node_types: dictionary of node type to residue characters.
     '''
-    def __init__(self, node_type_sequence, pwm):
+    def __init__(self, node_type_sequence, residues, weights, gaps, node_types=sequence.default_nodetypes):
         self.node_type_sequence = node_type_sequence
-        self.pwm = pwm
-        # Calculate total weight of each column
-        for pos in range(len(self.pwm)):
-            self.pwm[pos]['total'] = sum(self.pwm[pos][key] for key in self.pwm[pos] if not key=='total' and not key=='-')
+        self.residues = residues
+        width = len(node_type_sequence.seq)
+        self.integral = numpy.issubdtype(numpy.asarray(weights).dtype, numpy.integer)
+        self.weights = numpy.zeros((width, len(residues) + 1))
+        self.weights[:, :len(residues)] = weights
+        self.gaps = numpy.array(gaps, dtype=float)
+        self.totals = self.weights.sum(axis=1) # total weight of each column
+        self.index = numpy.full(256, len(residues), dtype=numpy.intp)
+        self.index[sequence.encode_residues(residues)] = numpy.arange(len(residues))
+        self.type_codes = node_type_sequence.get_type_codes(node_types)
+        cast = int if self.integral else float
+        self.pwm = []
+        for pos in range(width):
+            column = {residues[n]: cast(weight) for n, weight in enumerate(self.weights[pos, :-1].tolist()) if weight != 0}
+            if self.gaps[pos] != 0:
+                column['-'] = cast(self.gaps[pos])
+            column['total'] = cast(self.totals[pos])
+            self.pwm.append(column)
 
 class Consensus():
     '''
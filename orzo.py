@@ -11,6 +11,7 @@ from msa import MultipleSequenceDriver, ConsensusFilterFactory
 from pairwise import PairwiseDriver
 #from scipy import cluster
 from sequence import NeuriteSequence
+from scoring import ScoreBounds
 os.system("taskset -p 0xff %d" % os.getpid())
 
 version = 1.0
@@ -156,7 +157,7 @@ def cluster_domains(domain_occurrences,node_types,subsmat,args):
     min_domain_size = 7 # maybe should be 8
     print("Clustering domains")
     # Set up pairwise alignment args
-    domain_args = {'f':None,'f2':None,'a':None,'subsmat':subsmat,'gap':-1,'gapopen':0,'matrix':None,'custom':None,'o':None,'n':args['n'],'node_types':None}
+    domain_args = {'f':None,'f2':None,'a':None,'subsmat':subsmat,'gap':-1,'gapopen':0,'matrix':None,'custom':None,'o':None,'n':args['n'],'node_types':None,'cache':args['cache'],'cache_size':args['cache_size']}
     input_state = InputWrapperState(domain_args)
     input_state.subsmat = subsmat
 
@@ -188,9 +189,18 @@ def cluster_domains(domain_occurrences,node_types,subsmat,args):
         #domains_ns = list([NeuriteSequence("D"+str(i),domains[i]) for i in range(len(domains))])
         domains_ns = list([NeuriteSequence(domains_sub[i],domains_sub[i]) for i in range(len(domains_sub))])
         domain_id_map = {domains_sub[i]:i for i in range(len(domains_sub))}
-        driver = PairwiseDriver(domains_ns, domains_ns, input_state, store_pairwise=True, score_type='num_gaps')
-        driver.start()
-        distance_mat = driver.get_score_matrix()
+        # Pairs whose residues cannot be matched with at most max_cluster_dist gaps are never
+        # in the same cluster; domains with no other in reach are not aligned at all
+        bounds = ScoreBounds(input_state.get_scoring_scheme())
+        in_reach = list([list([i != j and bounds.min_gaps(domains_ns[i],domains_ns[j]) <= max_cluster_dist
+                               for j in range(len(domains_ns))]) for i in range(len(domains_ns))])
+        aligned = list([i for i in range(len(domains_ns)) if any(in_reach[i])])
+        aligned_pos = {aligned[n]:n for n in range(len(aligned))}
+        if len(aligned) > 0:
+            aligned_ns = list([domains_ns[i] for i in aligned])
+            driver = PairwiseDriver(aligned_ns, aligned_ns, input_state, store_pairwise=True, score_type='num_gaps')
+            driver.start()
+            distance_mat = driver.get_score_matrix()
 
         '''
         Determine clusters from hierarchy ???
@@ -219,7 +229,10 @@ def cluster_domains(domain_occurrences,node_types,subsmat,args):
                 else:
                     for seed in clusters:
                         seed_pos = domain_id_map[seed]
-                        dist = max(distance_mat[domain_pos][seed_pos],distance_mat[seed_pos][domain_pos])
+                        if not in_reach[domain_pos][seed_pos]:
+                            continue # provably further than max_cluster_dist
+                        domain_row,seed_row = aligned_pos[domain_pos],aligned_pos[seed_pos]
+                        dist = max(distance_mat[domain_row][seed_row],distance_mat[seed_row][domain_row])
                         if dist <= max_cluster_dist and dist < closest_cluster[1]:
                             closest_cluster = seed,dist
 
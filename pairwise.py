@@ -1,65 +1,41 @@
-from matrix import StateMatrix, DirectionalMatrixWrapper
+from matrix import StateMatrix, DirectionalMatrixWrapper, ArrayStateMatrix, ArrayDirectionalMatrixWrapper
 from buffer import status_message
 import concurrent.futures
 import traceback
+import collections
+import heapq
+import os
+import shutil
 import sys
-from sequence import NeuriteSequence
+import tempfile
+import numpy
+from sequence import NeuriteSequence, type_a, type_c, type_t, no_type, collapse_duplicates
+import engine
+from scoring import ScoringScheme, ScoreBounds
+# Largest share of the total work given to a single pairwise task
+default_task_fraction = 0.01
+# Smallest share of a target's work, in DP cells, that is split into its own task
+default_task_cells = 250000
+# Queries aligned at a time in top-k mode between checks of their score bounds
+default_bound_batch = 64
 # from random import shuffle
 
-def create_ta_dictionary(seq,node_types,submatrix=None,gap_cost=-1):
-	'''
-	Creates a dictionary for a given tree sequence linking each T node to 
-	an associated A node.
-	'''
-	if submatrix is None:
-		submatrix = {}
-
-	for nodetype in node_types:
-		if not (nodetype,'-') in submatrix.keys():
-			submatrix[(nodetype,'-')] = gap_cost
-
-	# Dictionary with (key,value) pairs of (T-node index, A-node index) as well as (str(T-node index), total gap cost)
-	taDict = {}
-	AStack = []
-	AStack.append(-1) # Begin the AStack with a sentinal value
-	CostStack = []
-	CostStack.append(0)
-	# Visit each character in the sequence
-	for index in range(0,len(seq)):
-		# Add the cost of the current node to the current gap cost register
-		CostStack[-1] += submatrix[seq[index],'-']
-
-		# If the current node is an A-node
-		if seq[index] in node_types['A']:
-			# push it onto the top of the stack
-			AStack.append(index)
-			# push on a new gap cost register
-			CostStack.append(0)
-			# The cost of an A-node at the front of a gap is added on in
-			# NeedlemanWunsch.calculate_gap when determining whether the A is gapped or is
-			# matched to a C-node
-
-		# If the current node is a T-node
-		elif seq[index] in node_types['T']:
-			# Set the dictionary to contain the (T-node index, associated A-node pair)
-			taDict[index] = AStack.pop()
-			# Get the cost of the gap between the T and A nodes
-			currCost = CostStack.pop()
-			# Add that cost to the dictionary
-			taDict[str(index)] = currCost
-			# Add the cost to the enclosing AT pair
-			if (len(CostStack) > 0):
-				CostStack[-1] += currCost
-	return taDict
-
-
 class PairwiseDriver():
     '''
     Executes the local alignment application
     '''
-    def __init__(self, targets, queries, input_state=None, store_pairwise=False, score_type='alignment_score', **kwargs):
+    def __init__(self, targets, queries, input_state=None, store_pairwise=False, score_type='alignment_score', band=None, symmetric=True, **kwargs):
         self.targets = targets # core operates given targets and queries
         self.queries = queries
+        self.row_parts = {} # target index => {first query index => results} of its tasks
+        self.row_tasks = {} # target index => number of tasks of the row
+        self.row_results = {} # target index => results of the row, until written
+        self.upper = {} # target index => results of queries after it not yet mirrored (symmetric mode)
+        self.next_row = 0 # index of the next row to write
+        # A target identical to an earlier one copies that row rather than being aligned
+        self.target_copies = collapse_duplicates(targets) # target index => index of the row it copies
+        self.kept_rows = {} # target index => its row, kept until written for its copies
+        self.copies_left = {} # target index => copies of its row still to write
         self.num_complete = 0 # len(self.priorCompletions) # for how many sequences have been aligned
         self.store_pairwise = store_pairwise
         if store_pairwise:
@@ -74,43 +50,214 @@ class PairwiseDriver():
 
         self.costs = input_state.get_penalties() # set costs to core
         self.submat = input_state.get_submatrix() # set submatrix to core
+        self.scoring = input_state.get_scoring_scheme() # compiled costs and submatrix
+        self.num_workers = input_state.get_args()['n']
+        # Get node type lists
+        self.node_types = input_state.get_node_types()
+        self.engine_type = input_state.get_engine()
+        # Without alignment output or gap counts only the score is needed, so
+        # the array engine can run in linear memory
+        self.engine_options = input_state.get_engine_options()
+        if input_state.get_args()['a'] is None and score_type == 'alignment_score' \
+            and self.engine_type == 'array':
+            self.engine_options['score_only'] = True
+        # A band given here overrides the one given on the command line
+        if band is not None:
+            if self.engine_type != 'array':
+                raise IOError('Banded alignment requires the array engine')
+            self.engine_options['band'] = band
+        # In sparse mode only the hits of each target are output: those scoring
+        # at least min_score, and at most the topk best
+        self.topk = None
+        if 'topk' in input_state.get_args().keys() and input_state.get_args()['topk'] is not None:
+            self.topk = input_state.get_args()['topk']
+        self.min_score = None
+        if 'min_score' in input_state.get_args().keys() and input_state.get_args()['min_score'] is not None:
+            self.min_score = input_state.get_args()['min_score']
+        self.sparse = self.topk is not None or self.min_score is not None
+        if self.sparse and score_type != 'alignment_score':
+            raise IOError('Top hits (topk, min_score) are selected by alignment score only')
+        self.pending_hits = {} # target index => hits mirrored from earlier rows (sparse symmetric mode)
+        # In sparse mode, pairs whose node type k-mers are too dissimilar may be
+        # skipped; the prefilter is a (k, sensitivity, audit) tuple, or None
+        self.prefilter = None
+        if self.sparse and 'prefilter' in input_state.get_args().keys() and input_state.get_args()['prefilter']:
+            self.prefilter = (input_state.get_args()['prefilter_k'], input_state.get_args()['prefilter'],
+                              input_state.get_args()['prefilter_audit'])
+        # Pairs of sparse mode skipped by the prefilter, or by their score bound
+        self.sparse_counts = {'evaluated': 0, 'skipped': 0, 'bounded': 0, 'hits': 0, 'missed': 0}
+        # Aligning a set against itself with symmetric scoring, only the upper
+        # triangle is aligned and the rest mirrored from it. The best hits of
+        # a row cannot be mirrored, as they depend on the whole row, nor can
+        # gap counts, as swapping the sequences may change the best alignment.
+        self.symmetric = symmetric and self.scoring.symmetric and self.is_self_comparison() \
+            and self.topk is None and score_type == 'alignment_score'
+        # Largest share of the total work a single task may take
+        self.task_fraction = default_task_fraction
+        if 'task_fraction' in input_state.get_args().keys() and input_state.get_args()['task_fraction'] is not None:
+            self.task_fraction = input_state.get_args()['task_fraction']
+
         scoremat_outfile = input_state.get_args()['o']
-        
+        alignment_outfile = input_state.get_args()['a']
+        self.scoremat_outfile = scoremat_outfile
+        self.alignment_outfile = alignment_outfile
+        self.output_format = 'tab'
+        if 'o_format' in input_state.get_args().keys() and input_state.get_args()['o_format'] is not None:
+            self.output_format = input_state.get_args()['o_format']
+        self.header_written = False
         # Set openMode to append if some targets have already been run and completed
-        if self.num_complete > 0:
+        if 'resume' in input_state.get_args().keys() and input_state.get_args()['resume'] \
+            and self.output_format == 'tab' \
+            and scoremat_outfile is not None and os.path.exists(scoremat_outfile):
+            self.resume(scoremat_outfile, alignment_outfile)
+        if self.header_written:
             openMode = 'a'
         else:
             openMode = 'w'
             
         self.scorehandle = None
-        if not scoremat_outfile is None:
+        self.score_memmap = None
+        if scoremat_outfile is not None and self.output_format == 'npy':
+            self.score_memmap = create_score_matrix(scoremat_outfile, self.targets, self.queries)
+        elif not scoremat_outfile is None:
             self.scorehandle = open(scoremat_outfile, openMode) # output file
 
         self.alignhandle = None
-        if input_state.get_args()['a'] is not None:
-            self.alignhandle = open(input_state.get_args()['a'], openMode) # alignments file
-            
-        self.num_workers = input_state.get_args()['n']
-        # Get node type lists
-        self.node_types = input_state.get_node_types()
+        if alignment_outfile is not None:
+            self.alignhandle = open(alignment_outfile, openMode) # alignments file
+
+        # In sharded mode each worker writes its results to its own files in
+        # shard_dir, which are merged into the output files at the end
+        self.shard_dir = None
+        self.failed_rows = set() # target indices with a failed task (sharded mode)
+        if 'shard_output' in input_state.get_args().keys() and input_state.get_args()['shard_output']:
+            outdir = None
+            if scoremat_outfile is not None:
+                outdir = os.path.dirname(os.path.abspath(scoremat_outfile))
+            self.shard_dir = tempfile.mkdtemp(prefix='shards', dir=outdir)
+        # Persistent cache of alignments from earlier runs, if requested
+        self.cache = input_state.get_alignment_cache()
 
         self.debug = 0
 
     def set_debug(val):
         self.debug = val
 
+    # Build the subtree index of every sequence once, so it ships with the
+    # sequences to the workers rather than being rebuilt for every pair
+    def index_subtrees(self):
+        gap_costs = self.scoring.gap_costs
+        for sequences in (self.targets, self.queries):
+            for sequence in sequences:
+                if set(sequence.seq) <= gap_costs.keys(): # otherwise the alignment itself reports the error
+                    sequence.get_subtree_index(self.node_types, gap_costs)
+                if self.prefilter is not None:
+                    sequence.get_kmer_counts(self.prefilter[0], self.node_types)
+
+    # Whether the targets and queries are the same sequences
+    def is_self_comparison(self):
+        if self.targets is self.queries:
+            return True
+        return len(self.targets) == len(self.queries) and \
+            all(t.name == q.name and t.seq == q.seq for t, q in zip(self.targets, self.queries))
+
+    # Splits the work into tasks aligning a target against a slice of the
+    # queries. The cost of a task is estimated as the length of the target
+    # times the summed length of its queries. Only a target costing more than
+    # both task_fraction of the total and default_task_cells is split, into
+    # slices of about equal cost within those limits.
+    # Targets that copy an earlier row get no task, and identical queries within
+    # a task are aligned once; the pairs left to align are counted in pairs_aligned, out of pairs_total.
+    # Returns (cost, target index, first query, last query + 1) tuples, most costly first.
+    def plan_tasks(self):
+        num_queries = len(self.queries)
+        prefix = numpy.concatenate(([0], numpy.cumsum([len(q.seq) for q in self.queries], dtype=numpy.int64)))
+        # rows of a resumed run are done
+        rows = [index for index in range(self.next_row, len(self.targets)) if self.target_copies[index] == index]
+        firsts = {index: index if self.symmetric else 0 for index in rows}
+        total = sum(len(self.targets[index].seq) * int(prefix[-1] - prefix[firsts[index]])
+                    for index in rows)
+        cap = max(self.task_fraction * total, default_task_cells)
+        tasks = []
+        for index in rows:
+            length = len(self.targets[index].seq)
+            start = first = firsts[index]
+            cost = length * int(prefix[-1] - prefix[start])
+            slices = max(min(int(numpy.ceil(cost / cap)), num_queries - start), 1)
+            for n in range(1, slices + 1):
+                stop = num_queries
+                if n < slices: # the query closest to the end of n equal shares of the row
+                    share = prefix[start] + (prefix[-1] - prefix[start]) * n / slices
+                    stop = int(numpy.searchsorted(prefix, share, side='right')) - 1
+                    stop = min(max(stop, first + 1), num_queries - (slices - n))
+                tasks.append((length * int(prefix[stop] - prefix[first]), index, first, stop))
+                first = stop
+        tasks.sort(key=lambda task: -task[0]) # longest processing time first
+        # the index of the previous identical query, -1 for the first
+        previous = numpy.full(num_queries, -1, dtype=numpy.int64)
+        last_seen = {}
+        for n, query in enumerate(self.queries):
+            previous[n] = last_seen.get(query.seq, -1)
+            last_seen[query.seq] = n
+        self.pairs_total = sum(num_queries - (index if self.symmetric else 0)
+                               for index in range(self.next_row, len(self.targets)))
+        self.pairs_aligned = sum(int((previous[first:stop] < first).sum()) for cost, index, first, stop in tasks)
+        return tasks
+
     # Initialize the core given query sequences and input arguments
     def start(self):
         status_message('Pairwise alignment running', 'please wait')
-        executor = concurrent.futures.ProcessPoolExecutor(self.num_workers)
+        self.index_subtrees()
+        # the sequences and scoring are shipped to each worker once, and each
+        # job only names the index of its target
+        executor = concurrent.futures.ProcessPoolExecutor(self.num_workers, initializer=_init_worker,
+                                                          initargs=(self.targets, self.queries, self.scoring,
+                                                                    self.engine_type, self.engine_options,
+                                                                    self.shard_dir, self.score_type,
+                                                                    self.alignhandle is not None,
+                                                                    self.topk, self.min_score, self.cache,
+                                                                    self.prefilter))
+        if self.cache is not None:
+            cache_before = self.cache.counters()
         try:
-            for target in self.targets: # per fasta, create a concurrent job, f.
-                f = executor.submit(_aligner, target, 
-                                    self.queries, self.costs, 
-                                    self.submat, self.node_types)
-                f.add_done_callback(self._callback)
+            tasks = self.plan_tasks()
+            if self.pairs_aligned < self.pairs_total:
+                status_message('Duplicate sequences collapsed: aligning ' + str(self.pairs_aligned) + ' of ' +
+                               str(self.pairs_total) + ' pairs (' +
+                               str(round(100 - 100.0 * self.pairs_aligned / self.pairs_total, 1)) + '% saved)', 'OK')
+            for index in range(self.next_row, len(self.targets)):
+                copied = self.target_copies[index]
+                if copied != index:
+                    self.copies_left[copied] = self.copies_left.get(copied, 0) + 1
+            for index in list(self.kept_rows.keys()): # kept on resume, but no copy left to write
+                if not index in self.copies_left:
+                    del self.kept_rows[index]
+            for cost, index, first, stop in tasks:
+                self.row_tasks[index] = self.row_tasks.get(index, 0) + 1
+            for cost, index, first, stop in tasks: # per task, create a concurrent job, f.
+                f = executor.submit(_indexed_aligner, index, first, stop)
+                f.add_done_callback(lambda f, index=index, first=first: self._callback(index, first, f))
             executor.shutdown()
+            if self.shard_dir is not None:
+                self.merge_shards()
+            else:
+                self._emit_ready_rows() # copies with no task after them
             self.close_output_buffers()
+            if self.cache is not None:
+                cache_after = self.cache.counters()
+                status_message('Alignment cache: ' + str(cache_after['hits'] - cache_before['hits']) + ' hits, ' +
+                               str(cache_after['misses'] - cache_before['misses']) + ' misses', 'OK')
+            counts = self.sparse_counts
+            if self.sparse:
+                status_message('Score bounds: skipped ' + str(counts['bounded']) + ' of ' +
+                               str(counts['evaluated']) + ' pairs', 'OK')
+            if self.prefilter is not None:
+                message = 'Prefilter: skipped ' + str(counts['skipped']) + ' of ' + str(counts['evaluated']) + ' pairs'
+                if self.prefilter[2]:
+                    message += '; missed ' + str(counts['missed']) + ' of ' + str(counts['hits']) + ' hits'
+                    if counts['hits'] > 0:
+                        message += ' (' + str(round(100.0 * counts['missed'] / counts['hits'], 2)) + '% false negatives)'
+                status_message(message, 'OK')
             status_message('Analysis complete', 'OK')
         except KeyboardInterrupt:
             executor.shutdown()
@@ -121,83 +268,654 @@ class PairwiseDriver():
             self.alignhandle.close()
         if self.scorehandle is not None:
             self.scorehandle.close()
+        if self.score_memmap is not None:
+            self.score_memmap.flush()
 
     # Get the headers, i.e. top-most row for the score matrix
-    def _create_header(self, results):
-        h = '\t' +'\t'.join([h[-1] for h in results])
+    def _create_header(self):
+        h = '\t' +'\t'.join([q.name for q in self.queries])
         self.scorehandle.write(h + '\n')
         self.scorehandle.flush()
-        
-    # Callback function once a thread is complete
-    def _callback(self, return_val):
+        self.header_written = True
+
+    # Reads the rows completed by an earlier run from the score and alignment
+    # files, and truncates both files after the last complete row so the
+    # missing rows can be appended. A row is complete when its score line has
+    # a score per query and, with an alignment file, its alignments are all
+    # written. Sets the index of the next row to align.
+    def resume(self, scoremat_outfile, alignment_outfile):
+        score_lines = _complete_lines(scoremat_outfile)
+        header = '\t' + '\t'.join([q.name for q in self.queries])
+        if len(score_lines) == 0 or score_lines[0][0] != header:
+            _truncate(scoremat_outfile, 0) # no usable header, start over
+            _truncate(alignment_outfile, 0)
+            return
+        align_lines = []
+        if alignment_outfile is not None:
+            align_lines = [(line.split('\t'), end) for line, end in _complete_lines(alignment_outfile)]
+        score_end, align_end = score_lines[0][1], 0
+        index, a = 0, 0 # next target and alignment line
+        copied = set(copied for index, copied in enumerate(self.target_copies) if copied != index)
+        for line, end in score_lines[1:]:
+            fields = line.split('\t')
+            # rows are in target order, with the rows of failed targets missing
+            row = next((i for i in range(index, len(self.targets)) if self.targets[i].name == fields[0]), None)
+            if row is None or len(fields) != len(self.queries) + 1:
+                break
+            alignments = {}
+            if alignment_outfile is not None:
+                first = a
+                while a < len(align_lines) and align_lines[a][0][0] == fields[0]:
+                    alignments[align_lines[a][0][1]] = (align_lines[a][0][2], align_lines[a][0][3])
+                    a += 1
+                if a == len(align_lines) and a - first < len(self.queries):
+                    break # alignments of the last row were cut off
+            scores = [_parse_score(s) for s in fields[1:]]
+            if self.store_pairwise:
+                self.score_dict[fields[0]] = scores
+            if self.symmetric:
+                for j in range(index, row + 1):
+                    self._take_upper(j)
+                    self.upper[j] = None
+                self._keep_upper(row, scores[row:], [alignments.get(q.name) for q in self.queries[row:]])
+            if row in copied:
+                self.kept_rows[row] = (scores, [alignments.get(q.name) for q in self.queries])
+            score_end = end
+            if a > 0:
+                align_end = align_lines[a - 1][1]
+            index = row + 1
+            self.num_complete += 1
+        _truncate(scoremat_outfile, score_end)
+        _truncate(alignment_outfile, align_end)
+        self.header_written = True
+        self.next_row = index
+        status_message('Resuming after ' + str(self.num_complete) + ' completed targets', 'OK')
+
+    # Callback function once a thread is complete; the tasks of a row are
+    # joined and rows are written in target order
+    def _callback(self, index, first, return_val):
         cbexcept = return_val.exception()
         if cbexcept is not None:
             print("Err1: "+str(cbexcept))
             #print("Targets: "+str(list([x.seq for x in self.targets])))
             #print("Queries: "+str(list([x.seq for x in self.queries])))
-        res = return_val.result() # get result once thread is complete
-        target, results = res
-        #results = sorted(results, key=lambda x: x[-1]) # sort by query (last item)
+            results = None
+        else:
+            target, results = return_val.result()[:2] # get result once thread is complete
+            if self.sparse:
+                for key, count in return_val.result()[2].items():
+                    self.sparse_counts[key] += count
+        if self.shard_dir is not None: # the worker wrote the results to its shard
+            if results is None:
+                self.failed_rows.add(index)
+            return
+        parts = self.row_parts.setdefault(index, {})
+        parts[first] = results
+        if len(parts) == self.row_tasks[index]:
+            del self.row_parts[index]
+            if any(results is None for results in parts.values()):
+                self.row_results[index] = None # the row is skipped
+            else:
+                self.row_results[index] = [r for first in sorted(parts) for r in parts[first]]
+        self._emit_ready_rows()
+
+    # Writes the rows ready to be written in target order
+    def _emit_ready_rows(self):
+        while self.next_row < len(self.targets):
+            index = self.next_row
+            if self.target_copies[index] != index:
+                self._emit_copy(index)
+            elif not index in self.row_results:
+                break
+            elif self.sparse:
+                self._emit_hits(index, self.row_results.pop(index))
+            else:
+                results = self.row_results.pop(index)
+                scores = alignments = None
+                if results is not None:
+                    scores = _result_scores(results, self.score_type)
+                    alignments = [r[1] for r in results]
+                self._emit_row(index, scores, alignments)
+            self.next_row += 1
+
+    # Writes a row given the scores and alignments of its task(s), None if
+    # one failed
+    def _emit_row(self, index, scores, alignments):
+        if self.symmetric:
+            scores, alignments = self._mirror_row(index, scores, alignments)
+        if index in self.copies_left:
+            self.kept_rows[index] = None if scores is None else (scores, alignments)
+        if scores is not None:
+            self._write_row(index, scores, alignments)
 
-        # determine scores
-        if self.score_type == 'alignment_score':
-            scores = [result[0] for result in results]
-        elif self.score_type == 'num_gaps':
-            scores = [result[1][0].count('-')+result[1][1].count('-') for result in results]
+    # Writes the row of a target identical to an earlier one, copying that row
+    def _emit_copy(self, index):
+        copied = self.target_copies[index]
+        row = self.kept_rows.get(copied) # None if that row failed
+        self.copies_left[copied] -= 1
+        if self.copies_left[copied] == 0:
+            self.kept_rows.pop(copied, None)
+        if self.sparse:
+            self.pending_hits.pop(index, None) # the copied row has them already
+            if row is not None:
+                if self.symmetric:
+                    self._mirror_hits(index, row)
+                self._write_hits(index, row)
+            return
+        scores, alignments = row if row is not None else (None, None)
+        if self.symmetric:
+            self._take_upper(index)
+            self._keep_upper(index, None if scores is None else scores[index:],
+                             None if scores is None else alignments[index:])
+        if scores is not None:
+            self._write_row(index, scores, alignments)
 
+    # Writes the [query index, score, alignment] hits of a row, best first;
+    # in symmetric mode with the hits of earlier rows against this target
+    def _emit_hits(self, index, hits):
+        if self.symmetric:
+            mirrored = self.pending_hits.pop(index, [])
+            if hits is not None:
+                self._mirror_hits(index, hits)
+                hits = mirrored + hits
+        if hits is not None:
+            hits = _best_hits(hits, self.topk)
+        if index in self.copies_left:
+            self.kept_rows[index] = hits
+        if hits is not None:
+            self._write_hits(index, hits)
+
+    # Passes the hits of a row on to the later rows of their queries, with
+    # the aligned strings swapped (sparse symmetric mode)
+    def _mirror_hits(self, index, hits):
+        for query, score, alignment in hits:
+            if query > index:
+                if alignment is not None:
+                    alignment = (alignment[1], alignment[0])
+                self.pending_hits.setdefault(query, []).append([index, score, alignment])
+
+    # Writes the hits of a row as an edge list
+    def _write_hits(self, index, hits):
+        target = self.targets[index].name
+        # an edge list of target, query and score
+        if self.scorehandle is not None:
+            for query, score, alignment in hits:
+                self.scorehandle.write(target + '\t' + self.queries[query].name + '\t' + str(score) + '\n')
+            self.scorehandle.flush()
+        if self.alignhandle is not None:
+            for query, score, alignment in hits:
+                if alignment is not None:
+                    out_str = target + '\t' + self.queries[query].name +'\t'+ alignment[0] +'\t'+ alignment[1]
+                    self.alignhandle.write(out_str + '\n')
+            self.alignhandle.flush()
+        self.num_complete += 1
+
+    # Merges the shard files written by the workers into the output files,
+    # row by row in target order, and removes them
+    def merge_shards(self):
+        status_message('Merging worker output', 'please wait')
+        shard_files = sorted(os.listdir(self.shard_dir))
+        parts = {} # target index => {first query index => scores}
+        for fname in shard_files:
+            if fname.endswith('.scores'):
+                with open(os.path.join(self.shard_dir, fname)) as handle:
+                    for line in handle:
+                        fields = line.rstrip('\n').split('\t')
+                        parts.setdefault(int(fields[0]), {})[int(fields[1])] = \
+                            [_parse_score(s) for s in fields[2:]]
+        # alignments are read back row by row from their offsets in the shards
+        offsets = {} # (target index, query index) => (shard handle, offset)
+        handles = []
+        for fname in shard_files:
+            if fname.endswith('.alignments'):
+                handle = open(os.path.join(self.shard_dir, fname), 'rb')
+                handles.append(handle)
+                offset = 0
+                for line in handle:
+                    index, query = line.split(b'\t', 2)[:2]
+                    offsets[int(index), int(query)] = (handle, offset)
+                    offset += len(line)
+        for index in range(self.next_row, len(self.targets)):
+            scores = alignments = None
+            if index in parts and not index in self.failed_rows:
+                scores = [score for first in sorted(parts[index]) for score in parts[index].pop(first)]
+                first = index if self.symmetric else 0
+                alignments = [None] * len(scores)
+                for n in range(len(scores)):
+                    if (index, first + n) in offsets:
+                        handle, offset = offsets.pop((index, first + n))
+                        handle.seek(offset)
+                        fields = handle.readline().decode().rstrip('\n').split('\t')
+                        alignments[n] = (fields[2], fields[3])
+            if self.target_copies[index] != index:
+                self._emit_copy(index)
+            else:
+                self._emit_row(index, scores, alignments)
+        self.next_row = len(self.targets)
+        for handle in handles:
+            handle.close()
+        shutil.rmtree(self.shard_dir)
+
+    # Keeps the results of a row against the queries after it, from which
+    # the later rows are mirrored (symmetric mode). Aligned strings are only
+    # kept if they are written out.
+    def _keep_upper(self, index, scores, alignments):
+        if scores is None or len(scores) < 2:
+            self.upper[index] = None
+        elif self.alignment_outfile is not None:
+            self.upper[index] = (collections.deque(scores[1:]), collections.deque(alignments[1:]))
+        else:
+            self.upper[index] = (collections.deque(scores[1:]), None)
+
+    # Takes the results of the rows before index against query index from
+    # what they keep, with the aligned strings swapped; a row is released
+    # once its last query has been taken. Called for every row in order.
+    def _take_upper(self, index):
+        scores, alignments = [], []
+        for j in range(index):
+            score = alignment = None
+            if self.upper[j] is not None:
+                score = self.upper[j][0].popleft()
+                if self.upper[j][1] is not None:
+                    alignment = self.upper[j][1].popleft()
+                if len(self.upper[j][0]) == 0:
+                    self.upper[j] = None
+            if alignment is not None:
+                alignment = (alignment[1], alignment[0])
+            scores.append(score)
+            alignments.append(alignment)
+        return scores, alignments
+
+    # Completes row index of the symmetric mode from the rows before it: the
+    # result of query j < index is that of target j against query index,
+    # with the aligned strings swapped
+    def _mirror_row(self, index, scores, alignments):
+        mirrored_scores, mirrored_alignments = self._take_upper(index)
+        self._keep_upper(index, scores, alignments)
+        if scores is None:
+            return None, None
+        return mirrored_scores + scores, mirrored_alignments + alignments
+
+    # Writes the scores and alignments of one target against all queries
+    def _write_row(self, index, scores, alignments):
+        target = self.targets[index].name
 	# save scores
         if self.store_pairwise:
             self.score_dict[target] = scores
 
+        # or write them in place in the score matrix
+        if self.score_memmap is not None:
+            self.score_memmap[index] = [numpy.nan if s is None else s for s in scores]
+
         # write scores to output file
         if self.scorehandle is not None:
-            if self.num_complete == 0: # for the first result, write headers
-                self._create_header(results)
+            if not self.header_written: # for the first result, write headers
+                self._create_header()
             scores = '\t'.join([str(s) for s in scores])
             self.scorehandle.write(target + '\t' + scores + '\n')
             self.scorehandle.flush()
 
         # also save actual alignment string
         if self.alignhandle is not None:
-            for r in results:
-                if r[1] is not None:
-                    align_target, align_query = r[1]
-                    out_str = target + '\t' + r[-1] +'\t'+ align_target +'\t'+ align_query
+            for query, alignment in zip(self.queries, alignments):
+                if alignment is not None:
+                    align_target, align_query = alignment
+                    out_str = target + '\t' + query.name +'\t'+ align_target +'\t'+ align_query
                     self.alignhandle.write(out_str + '\n')
-                    self.alignhandle.flush()
+            self.alignhandle.flush()
         self.num_complete += 1
         if self.debug >= 1:
             print(' --> ' + target + ' [OK] '+str(self.num_complete) +
                 ' of '+ str(len(self.targets))) # print progress
 
     def get_score_matrix(self):
+        if self.score_memmap is not None: # the written matrix, mapped rather than read
+            return open_score_matrix(self.scoremat_outfile)[0]
         score_mat = []
         for target in self.targets:
             if target.name in self.score_dict:
                 score_mat.append(self.score_dict[target.name])
         return score_mat
         
-# Maps each query sequence against a set of targets (itself)
-def _aligner(target, queries, costs, submat, node_types):
+# Creates a float32 .npy score matrix of targets by queries, memory-mapped
+# and filled with nan, along with its name index: fname + '.names' holds a
+# header of the query names, like a score file, then a target name per row
+def create_score_matrix(fname, targets, queries):
+    score_memmap = numpy.lib.format.open_memmap(fname, mode='w+', dtype=numpy.float32,
+                                                shape=(len(targets), len(queries)))
+    score_memmap[:] = numpy.nan
+    with open(fname + '.names', 'w') as handle:
+        handle.write('\t' + '\t'.join([q.name for q in queries]) + '\n')
+        for target in targets:
+            handle.write(target.name + '\n')
+    return score_memmap
+
+# Opens a score matrix written with -o_format npy without copying it into
+# memory. Returns the read-only memory-mapped matrix (nan where no score was
+# written), the target names of its rows and the query names of its columns.
+def open_score_matrix(fname):
+    with open(fname + '.names') as handle:
+        query_names = handle.readline().rstrip('\n').split('\t')[1:]
+        target_names = [line.rstrip('\n') for line in handle]
+    return numpy.load(fname, mmap_mode='r'), target_names, query_names
+
+# Get the lines of a file ending in a newline, each with the byte offset of
+# its end; a missing file has none
+def _complete_lines(fname):
+    if fname is None or not os.path.exists(fname):
+        return []
+    with open(fname, 'rb') as handle:
+        data = handle.read()
+    lines, start = [], 0
+    end = data.find(b'\n')
+    while end >= 0:
+        lines.append((data[start:end].decode(), end + 1))
+        start = end + 1
+        end = data.find(b'\n', start)
+    return lines
+
+# Truncate a file, if it exists, to the given number of bytes
+def _truncate(fname, size):
+    if fname is not None and os.path.exists(fname):
+        with open(fname, 'r+b') as handle:
+            handle.truncate(size)
+
+# Parse a score written to the score file
+def _parse_score(s):
+    if s == 'None':
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+# Data a worker process shares across its jobs, set by _init_worker
+_worker_state = {}
+
+# Loads the targets, queries and scoring into a worker process once; with a
+# shard directory, results are written there rather than returned
+def _init_worker(targets, queries, scoring, engine_type, engine_options,
+                 shard_dir=None, score_type='alignment_score', alignments=True,
+                 topk=None, min_score=None, cache=None, prefilter=None):
+    _worker_state.update(targets=targets, queries=queries, scoring=scoring, engine_type=engine_type,
+                         engine_options=engine_options, shard_dir=shard_dir, score_type=score_type,
+                         alignments=alignments, topk=topk, min_score=min_score, cache=cache,
+                         prefilter=prefilter, bounds=ScoreBounds(scoring))
+
+# Aligns the target of the given index against the queries of the worker
+# from first up to stop
+def _indexed_aligner(index, first, stop):
+    state = _worker_state
+    queries = state['queries'][first:stop]
+    # identical queries are aligned once, and their result given to each
+    unique = {}
+    for query in queries:
+        unique.setdefault(query.seq, query)
+    unique = list(unique.values())
+    target = state['targets'][index]
+    if state['topk'] is not None or state['min_score'] is not None:
+        return _sparse_aligner(target, unique, queries, first)
+    target, results = _aligner(target, unique, state['scoring'],
+                               state['engine_type'], state['engine_options'], state['cache'])
+    results = _fan_out(unique, results, queries)
+    if state['shard_dir'] is not None:
+        return target, _write_shard(index, first, results)
+    return target, results
+
+# Selects the hits of a target among the queries of a task, of which unique
+# are the distinct ones. Pairs the prefilter rejects are skipped, and so are
+# those whose score bound shows they cannot be hits: below min_score, or in
+# top-k mode below the topk-th best hit found so far, the queries with the
+# highest bounds being aligned first.
+# Returns the target name, its hits and the counts of skipped pairs.
+def _sparse_aligner(target, unique, queries, first):
+    state = _worker_state
+    topk, min_score = state['topk'], state['min_score']
+    align = lambda queries: _aligner(target, queries, state['scoring'], state['engine_type'],
+                                     state['engine_options'], state['cache'])[1]
+    counts = {'evaluated': len(unique)}
+    keep = numpy.ones(len(unique), dtype=bool)
+    if state['prefilter'] is not None:
+        k, sensitivity, audit = state['prefilter']
+        keep = _kmer_similarity(target, unique, k, state['scoring'].node_types) >= sensitivity
+        counts['skipped'] = int(len(unique) - keep.sum())
+        if audit:
+            # the audit aligns the skipped pairs too, counting the hits they would have missed
+            results = _fan_out(unique, align(unique), queries)
+            hits = _select_hits(results, first, topk, min_score)
+            keep = dict(zip([query.seq for query in unique], keep))
+            results = [result if keep[query.seq] else [None, None, query.name] for query, result in zip(queries, results)]
+            filtered = _select_hits(results, first, topk, min_score)
+            counts['hits'] = len(hits)
+            counts['missed'] = len(set(hit[0] for hit in hits) - set(hit[0] for hit in filtered))
+            return target.name, filtered, counts
+    bounds = state['bounds'].score_bounds(target, unique)
+    order = [n for n in numpy.argsort(-bounds, kind='stable') if keep[n]]
+    if min_score is not None:
+        order = [n for n in order if bounds[n] >= min_score]
+    results = [[None, None, query.name] for query in unique]
+    batch = len(order) if topk is None else max(topk, default_bound_batch)
+    aligned = 0
+    while aligned < len(order):
+        batch_order = order[aligned:aligned + batch]
+        for n, result in zip(batch_order, align([unique[n] for n in batch_order])):
+            results[n] = result
+        aligned += len(batch_order)
+        if topk is not None and aligned < len(order):
+            hits = _select_hits(_fan_out(unique, results, queries), first, topk, min_score)
+            if len(hits) == topk: # the rest must beat the worst of them
+                order = order[:aligned] + [n for n in order[aligned:] if bounds[n] >= hits[-1][1]]
+    counts['bounded'] = int(keep.sum()) - len(order)
+    return target.name, _select_hits(_fan_out(unique, results, queries), first, topk, min_score), counts
+
+# Gives the result of each of the unique queries to the queries identical to it
+def _fan_out(unique, results, queries):
+    if len(unique) == len(queries):
+        return results
+    results = {query.seq: result for query, result in zip(unique, results)}
+    return [[results[query.seq][0], results[query.seq][1], query.name] for query in queries]
+
+# Similarity of the node type k-mers of a target to those of each query: the
+# k-mers they share over the k-mers of the one with fewer. Sequences too
+# short to have k-mers are fully similar to all, so are never filtered.
+# Returns a numpy array.
+def _kmer_similarity(target, queries, k, node_types):
+    counts = target.get_kmer_counts(k, node_types)
+    shared = numpy.array([numpy.minimum(counts, query.get_kmer_counts(k, node_types)).sum()
+                          for query in queries], dtype=float)
+    fewer = numpy.minimum(counts.sum(), [query.get_kmer_counts(k, node_types).sum() for query in queries])
+    similarity = numpy.ones(len(queries))
+    numpy.divide(shared, fewer, out=similarity, where=fewer > 0)
+    return similarity
+
+# Selects the hits among the [score, alignment, name] results of queries
+# from first on: those scoring at least min_score, at most topk of them,
+# kept in a bounded heap. Returns [query index, score, alignment] hits, best first.
+def _select_hits(results, first, topk=None, min_score=None):
+    heap = []
+    for n, result in enumerate(results, first):
+        score = result[0]
+        if score is None or (min_score is not None and score < min_score):
+            continue
+        hit = (score, -n, result[1]) # on equal scores, the first query is best
+        if topk is None or len(heap) < topk:
+            heapq.heappush(heap, hit)
+        elif hit[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, hit)
+    return _best_hits([[-n, score, alignment] for score, n, alignment in heap], topk)
+
+# Sorts [query index, score, alignment] hits best first, keeping the topk best
+def _best_hits(hits, topk=None):
+    hits = sorted(hits, key=lambda hit: (-hit[1], hit[0]))
+    if topk is not None:
+        hits = hits[:topk]
+    return hits
+
+# Appends the scores and alignments of a task to the shard files of this
+# worker process, buffered and flushed once per task. A score line holds
+# the target index, first query index and the scores; an alignment line
+# the target index, query index and aligned strings.
+# Returns the number of results written.
+def _write_shard(index, first, results):
+    state = _worker_state
+    if not 'scorehandle' in state:
+        shard = os.path.join(state['shard_dir'], str(os.getpid()))
+        state['scorehandle'] = open(shard + '.scores', 'w')
+        state['alignhandle'] = open(shard + '.alignments', 'w') if state['alignments'] else None
+    scores = _result_scores(results, state['score_type'])
+    state['scorehandle'].write(str(index) + '\t' + str(first) + '\t' +
+                               '\t'.join([str(s) for s in scores]) + '\n')
+    state['scorehandle'].flush()
+    if state['alignhandle'] is not None:
+        for n, r in enumerate(results, first):
+            if r[1] is not None:
+                state['alignhandle'].write(str(index) + '\t' + str(n) + '\t' + r[1][0] + '\t' + r[1][1] + '\n')
+        state['alignhandle'].flush()
+    return len(results)
+
+# Get the output score of each [score, alignment, name] result
+def _result_scores(results, score_type):
+    if score_type == 'alignment_score':
+        return [result[0] for result in results]
+    elif score_type == 'num_gaps':
+        return [result[1][0].count('-')+result[1][1].count('-') for result in results]
+
+# Aligns s1 to s2 with the given engine, through the alignment cache if one
+# is given. Returns the [score, alignment, name] result.
+def align_pair(s1, s2, scoring, engine_type='array', engine_options=None, cache=None):
+    kwargs = engine_options or {}
+    if cache is not None:
+        result = cache.lookup(s1, [s2], alignment=not kwargs.get('score_only', False))[0]
+        if result is not None:
+            return result
+    NW = aligners[engine_type](s1, s2, scoring.costs, scoring.submat, scoring.node_types,
+                               scoring=scoring, **kwargs)
+    result = NW.prettify()
+    if cache is not None:
+        cache.store(s1, [s2], [result])
+    return result
+
+# Maps each query sequence against a set of targets (itself); with a cache,
+# only the pairs it does not hold are aligned, and then stored in it
+def _aligner(target, queries, scoring, engine_type='array', engine_options=None, cache=None):
     results = [] # K => target, V => aligned queries 
-    # get the gap and substitution matrix
+    aligner = aligners[engine_type]
+    kwargs = engine_options or {}
+    if cache is not None:
+        results = cache.lookup(target, queries, alignment=not kwargs.get('score_only', False))
+        missing = [queries[n] for n, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            aligned = _aligner(target, missing, scoring, engine_type, engine_options)[1]
+            cache.store(target, missing, aligned)
+            aligned = iter(aligned)
+            results = [next(aligned) if result is None else result for result in results]
+        return target.name, results
+    if engine_type == 'array' and kwargs.get('band') is None:
+        return target.name, _batch_aligner(target, queries, scoring, **kwargs)
+    # the gap and substitution matrix are compiled into scoring
     for query in queries:
-        NW = NeedlemanWunsch(target, query, costs, submat, node_types)
+        NW = aligner(target, query, scoring.costs, scoring.submat, scoring.node_types,
+                     scoring=scoring, **kwargs)
         output = NW.prettify()
         results.append(output)
     return target.name, results
 
+# Aligns a target against many queries with the batched array kernel, giving
+# the same results as ArrayNeedlemanWunsch per query. Queries are sorted into
+# buckets of similar length, padded, and each bucket is aligned at once.
+# Queries a batch cannot take or would not speed up (empty ones, those longer
+# than batch_length, those whose alignment is traced back in linear memory,
+# and buckets with fewer queries than their longest query has nodes) are
+# aligned one by one.
+# Returns the [score, alignment, name] triple of each query, in order.
+def _batch_aligner(target, queries, scoring, score_only=False, linear_cells=engine.default_linear_cells,
+                   batch_cells=engine.default_batch_cells, batch_length=engine.default_batch_length):
+    results = [None] * len(queries)
+    l1 = len(target.seq)
+    def align_single(n):
+        NW = ArrayNeedlemanWunsch(target, queries[n], scoring.costs, scoring.submat, scoring.node_types,
+                                  score_only=score_only, linear_cells=linear_cells, scoring=scoring)
+        results[n] = NW.prettify()
+    def align_bucket(bucket):
+        # the batch costs a Python loop per column, single pairs a kernel call per query
+        if len(bucket) < len(queries[bucket[-1]].seq):
+            for n in bucket:
+                align_single(n)
+        else:
+            _align_bucket(target, [queries[b] for b in bucket], scoring, score_only, bucket, results)
+    batched = []
+    for n, query in enumerate(queries):
+        cells = (l1 + 1) * (len(query.seq) + 1)
+        if l1 == 0 or len(query.seq) == 0 or len(query.seq) > batch_length or \
+            (not score_only and linear_cells is not None and cells > linear_cells):
+            align_single(n)
+        else:
+            batched.append(n)
+    # A bucket grows while padding stays within a quarter of its shortest query
+    batched.sort(key=lambda n: len(queries[n].seq))
+    bucket = []
+    for n in batched:
+        length = len(queries[n].seq)
+        if bucket and (length > len(queries[bucket[0]].seq) * 1.25 + 4 or
+                       (len(bucket) + 1) * (l1 + 1) * (length + 1) > batch_cells):
+            align_bucket(bucket)
+            bucket = []
+        bucket.append(n)
+    if bucket:
+        align_bucket(bucket)
+    return results
+
+# Aligns a target against a bucket of queries with engine.BatchAlignmentKernel,
+# storing each query's [score, alignment, name] triple at its index in results
+def _align_bucket(target, queries, scoring, score_only, indices, results):
+    node_types, gap_costs = scoring.node_types, scoring.gap_costs
+    gap, gapopen = scoring.gap, scoring.gapopen
+    table, gap_vector = scoring.table, scoring.gap_vector
+    pad = engine.BatchAlignmentKernel.pad
+    codes1 = scoring.encode(target)
+    codes2 = [scoring.encode(query) for query in queries]
+    paired1, major1 = target.get_subtree_index(node_types, gap_costs)
+    subtrees2 = [query.get_subtree_index(node_types, gap_costs) for query in queries]
+    batch_codes2 = pad(codes2, 0, numpy.intp)
+    kernel = engine.BatchAlignmentKernel(
+        target.get_type_codes(node_types),
+        pad([query.get_type_codes(node_types) for query in queries], no_type, numpy.int8),
+        gap_vector[codes1],
+        pad([gap_vector[codes] for codes in codes2], 0, float),
+        paired1,
+        pad([paired for paired, major in subtrees2], -1, numpy.intp),
+        major1,
+        pad([major for paired, major in subtrees2], 0, float),
+        lambda i: table[codes1[i-1], batch_codes2],
+        lambda i: table[batch_codes2, codes1[i-1]],
+        engine.border_scores(target.seq, True, gap, gapopen),
+        pad([engine.border_scores(query.seq, True, gap, gapopen) for query in queries], engine.neg_inf, float),
+        numpy.array([len(query.seq) for query in queries], dtype=numpy.intp),
+        gapopen,
+        score_only=score_only)
+    kernel.fill()
+    cast = int if scoring.integral else float
+    for b, query in enumerate(queries):
+        score = kernel.top_scores[b]
+        alignment = None
+        if not score_only:
+            alignment = kernel.query_traceback(b, target.seq, query.seq, False)
+        results[indices[b]] = [None if score is None else cast(score), alignment, query.name]
+
 # Implementation of global alignment - Needleman-Wunsch
 class NeedlemanWunsch():
-	def __init__(self, s1, s2, costs, submat, node_types, composite=0):
+	def __init__(self, s1, s2, costs, submat, node_types, composite=0, scoring=None):
+		if scoring is None: # compile costs and submat for this pair alone
+			scoring = ScoringScheme(submat, costs, node_types)
+		self.scoring = scoring # compiled scoring scheme, shared read-only
 		self.seq1 = s1 # sequence 1
 		self.seq2 = s2 # sequence 2
-		self.costs = costs # dictionary of all costs (i.e. penalties)
-		self.submat = submat # substitution matrix
+		self.costs = scoring.costs # dictionary of all costs (i.e. penalties)
+		self.submat = scoring.submat # substitution matrix, with gap and flipped entries
 		self.create_node_types(node_types)
-		self.create_residue_specific_gapcost()
-		self.TADict1 = create_ta_dictionary(s1.seq, node_types, submat, costs['gap'])
-		self.TADict2 = create_ta_dictionary(s2.seq, node_types, submat, costs['gap'])
+		self.create_type_codes(node_types)
+		self.create_residue_codes()
+		self.create_subtree_index(node_types, scoring.gap_costs)
 		self.scoreMat = None # references score matrix
 		self.directionMat = None # references diag(0),left(1),up(2) matrix
 		self.leftMat = None # references diag(0),left(1),up(2) matrix
@@ -213,34 +931,31 @@ class NeedlemanWunsch():
 		for node_type in node_types.keys():
 			for residue in node_types[node_type]:
 				self.node_types[residue] = node_type
+
+	# Node type codes per position, from the sequences' cached encodings
+	def create_type_codes(self,node_types):
+		self.type_codes1 = self.seq1.get_type_codes(node_types)
+		self.type_codes2 = self.seq2.get_type_codes(node_types)
+		self.types1 = self.type_codes1.tolist()
+		self.types2 = self.type_codes2.tolist()
+
+	# Paired A positions and subtree gap costs per position, from the sequences' cached subtree indices
+	def create_subtree_index(self,node_types,gap_costs):
+		self.subtrees1 = self.seq1.get_subtree_index(node_types, gap_costs)
+		self.subtrees2 = self.seq2.get_subtree_index(node_types, gap_costs)
+		self.paired1, self.major1 = [index.tolist() for index in self.subtrees1]
+		self.paired2, self.major2 = [index.tolist() for index in self.subtrees2]
 	
-	# Fills in all gap-residue pairs either with flipped order entry if it exists, else with the default gap cost
-	# Also fills in flipped residue-residue scores
-	def create_residue_specific_gapcost(self):
-		newToSubmat = {}
-		for pair in self.submat.keys():
-			if pair[0] == '-' and pair[1] == '-':
-				# do nothing, this is useless and shouldn't happen
-				pass
-			elif pair[0] == '-' or pair[1] == '-':
-				# Note that the given residue has an associated gap cost
-				if pair[0] == '-' and (pair[1],'-') not in self.submat.keys():
-					newToSubmat[pair[1],'-'] = self.submat[pair]
-				elif pair[1] == '-' and (pair[1],'-') not in self.submat.keys():
-					newToSubmat[pair[1],'-'] = self.submat[pair]
-			else:
-				# Fill the residueDict so none are missed
-				if (pair[0],'-') not in self.submat.keys() and ('-',pair[0]) not in self.submat.keys():
-					newToSubmat[pair[0],'-'] = self.costs['gap']
-					newToSubmat['-',pair[0]] = self.costs['gap']
-				if (pair[1],'-') not in self.submat.keys() and ('-',pair[1]) not in self.submat.keys():
-					newToSubmat[pair[1],'-'] = self.costs['gap']
-					newToSubmat['-',pair[1]] = self.costs['gap']
-				if (pair[1],pair[0]) not in self.submat.keys():
-					newToSubmat[pair[1],pair[0]] = self.submat[pair]
-		for pair in newToSubmat.keys():
-			self.submat[pair] = newToSubmat[pair]
-	
+	# Score table indices and gap costs per position, from the compiled scoring scheme
+	def create_residue_codes(self):
+		self.codes1 = self.scoring.encode(self.seq1)
+		self.codes2 = self.scoring.encode(self.seq2)
+		self.residues1 = self.codes1.tolist()
+		self.residues2 = self.codes2.tolist()
+		self.scores = self.scoring.score_lists
+		self.gaps1 = [self.scoring.gap_list[code] for code in self.residues1]
+		self.gaps2 = [self.scoring.gap_list[code] for code in self.residues2]
+
 	# return top (highest) alignment score given sequence 1 and 2
 	def get_top_score(self):
 		return self.scoreMat.get_data(-1,-1)
@@ -274,11 +989,18 @@ class NeedlemanWunsch():
 		return scoreExtendPair
 		
 	# Calculates the gap cost in a given direction from a given position, which depends on the node type
-	def calculate_gap(self,i,j,seq1,seq2,m,directionM,dirScoreM,TADict,gap_direction):
+	def calculate_gap(self,i,j,seq1,seq2,m,directionM,dirScoreM,subtrees,gap_direction):
 		isExtend = False
 		a_c_match = False
+		if gap_direction == 1:
+			types1, types2 = self.types1, self.types2
+			residues1, residues2, gaps1 = self.residues1, self.residues2, self.gaps1
+		else:
+			types1, types2 = self.types2, self.types1
+			residues1, residues2, gaps1 = self.residues2, self.residues1, self.gaps2
+		paired, major = subtrees
 		# CType: gap one
-		if self.node_types[seq1[i-1]] == 'C':
+		if types1[i-1] == type_c:
 			# The prior position assuming a gap (index based on m)
 			gapPosi = i - 1
 			gapPosj = j
@@ -288,18 +1010,18 @@ class NeedlemanWunsch():
 														m,
 														directionM,
 														dirScoreM,
-														get_gapcost(seq1[i-1],self.submat),
+														gaps1[i-1],
 														gap_direction)
 
 		# TType: gap until paired A
-		elif self.node_types[seq1[i-1]] == 'T': 
+		elif types1[i-1] == type_t:
 			# The prior position assuming a gap (index based on m)
-			gapPosi = TADict[i-1]
+			gapPosi = paired[i-1]
 			# Case where this is the last T; handle sentinal and get cost of front-gap
-			if TADict[i-1] is -1:
+			if paired[i-1] == -1:
 				gapPosi = 0
-			gapCostMajor = TADict[str(i-1)] # Cost of the gap from the T-node up to the A-node
-			gapCostStart = get_gapcost(seq1[gapPosi],self.submat) # Cost of the A-node that starts the gap
+			gapCostMajor = major[i-1] # Cost of the gap from the T-node up to the A-node
+			gapCostStart = gaps1[gapPosi] # Cost of the A-node that starts the gap
 
 			# Calculate the total gap cost assuming the associated A is also gapped
 			gapScoreGapFinish,isExtend = self.determine_open_extend(gapPosi,
@@ -311,10 +1033,10 @@ class NeedlemanWunsch():
 																gap_direction)
 
 			# If seq2 character is C-type, determine whether to match T-paired A and C, or to just gap the A
-			# This will not happen if this is the last T (TADict[i-1] is -1), as the whole sequence must be gapped
-			if self.node_types[seq2[j-1]] == 'C' and TADict[i-1] is not -1:
+			# This will not happen if this is the last T (paired[i-1] is -1), as the whole sequence must be gapped
+			if types2[j-1] == type_c and paired[i-1] != -1:
 				# Calculate the total gap cost assuming the associated A-node matches a C-node
-				ACScore = get_score(seq1[gapPosi],seq2[j-1],self.submat)
+				ACScore = self.scores[residues1[gapPosi]][residues2[j-1]]
 				if m.get_data(gapPosi,j-1) is None:
 					gapScoreACFinish = None
 				else:
@@ -389,14 +1111,15 @@ class NeedlemanWunsch():
 		for i in range(1, l1+1): # per base-pair in sequence 1 ...
 			for j in range(1, l2+1): # per base-pair in sequence 2, align them
 			
-				if (self.node_types[self.seq1.seq[i-1]] == 'C' and self.node_types[self.seq2.seq[j-1]] == 'A') or (self.node_types[self.seq1.seq[i-1]] == 'A' and self.node_types[self.seq2.seq[j-1]] == 'C'):
+				type1, type2 = self.types1[i-1], self.types2[j-1]
+				if (type1 == type_c and type2 == type_a) or (type1 == type_a and type2 == type_c):
 					score = None # no match if one is a C type and the other is an A type
-				elif (self.node_types[self.seq1.seq[i-1]] == 'T') ^ (self.node_types[self.seq2.seq[j-1]] == 'T'):
+				elif (type1 == type_t) ^ (type2 == type_t):
 					score = None # no match if one is a T type and the other is not
 				elif self.scoreMat.get_data(i-1,j-1) is None:
 					score = None # Diagonal is an unreachable position due to composite
 				else:
-					score = self.scoreMat.get_data(i-1,j-1) + get_score(self.seq1.seq[i-1], self.seq2.seq[j-1], self.submat)
+					score = self.scoreMat.get_data(i-1,j-1) + self.scores[self.residues1[i-1]][self.residues2[j-1]]
 				
 				left, up = None, None
 				if self.composite != 2: # If seq2 is composite, can't put gap characters in seq1
@@ -408,7 +1131,7 @@ class NeedlemanWunsch():
 													self.scoreMat,
 													self.directionMat,
 													self.leftMat,
-													self.TADict1,
+													(self.paired1, self.major1),
 													1)
 				if self.composite != 1: # If seq1 is composite, can't put gap characters in seq2
 					# Cost for gapping up (over sequence 2)
@@ -419,7 +1142,7 @@ class NeedlemanWunsch():
 												self.scoreMat.T,
 												self.directionMat.T,
 												self.upMat.T,
-												self.TADict2,
+												(self.paired2, self.major2),
 												2)
 				
 				
@@ -455,11 +1178,11 @@ class NeedlemanWunsch():
 			# if score is a gap in sequence 2 (direction is 1), only walk back on i
 			if keepGapping == 1 or keepGapping == 0 and self.directionMat.get_data(i,j) == 1:
 				# If the node being gapped is a T-node, appropriately gap the entire subtree
-				if self.node_types[self.seq1.seq[i-1]] == 'T':
+				if self.types1[i-1] == type_t:
 					# Get i_target and j_target depending on whether "forced" gapping or not
 					if keepGapping == 1:
 						# Determine whether T-gapping has includes the A node or matches A-C
-						i_target = self.TADict1[i-1]
+						i_target = self.paired1[i-1]
 						if self.leftMat.a_c_match.get_data(i,j) == True:
 							j_target = j-1
 						else:
@@ -498,11 +1221,11 @@ class NeedlemanWunsch():
 				
 			# if score is a gap in sequence 1 (direction is 2), only walk back on j
 			elif keepGapping == 2 or keepGapping == 0 and self.directionMat.get_data(i,j) == 2:
-				if self.node_types[self.seq2.seq[j-1]] == 'T':
+				if self.types2[j-1] == type_t:
 					# Get i_target and j_target depending on whether "forced" gapping or not
 					if keepGapping == 2:
 						# Determine whether T-gapping has includes the A node or matches A-C
-						j_target = self.TADict2[j-1]
+						j_target = self.paired2[j-1]
 						if self.upMat.a_c_match.get_data(i,j) == True:
 							i_target = i-1
 						else:
@@ -558,22 +1281,118 @@ class NeedlemanWunsch():
 		self.align1 = self.align1[::-1]
 		self.align2 = self.align2[::-1]
 
+# Runs the kernel of an array-backed aligner and sets its score and matrices.
+# Above linear_cells DP cells the traceback is done in linear memory and no
+# matrices are kept; with score_only no alignment is produced at all.
+# With a band only cells near the diagonal are filled, widening as needed.
+# Returns the pair of aligned strings, or None if score_only.
+def _run_kernel(aligner, kernel, forced_up_ac, integral):
+	# Against an empty sequence the score is the gap border alone, built from the costs
+	if len(aligner.seq1.seq) == 0 or len(aligner.seq2.seq) == 0:
+		integral = all(isinstance(v, int) for v in aligner.costs.values())
+	cast = int if integral else float
+	alignment = None
+	filled = aligner.band is not None
+	if filled:
+		kernel.fit_band(aligner.band)
+	if aligner.score_only:
+		if not filled:
+			kernel.fill()
+	elif kernel.score_only:
+		block_rows = max(1, aligner.linear_cells // (len(aligner.seq2.seq) + 1))
+		alignment = kernel.linear_traceback(aligner.seq1.seq, aligner.seq2.seq, forced_up_ac, block_rows)
+	else:
+		if not filled:
+			kernel.fill()
+		alignment = kernel.traceback(aligner.seq1.seq, aligner.seq2.seq, forced_up_ac)
+		aligner.scoreMat = ArrayStateMatrix(kernel.score, null=engine.neg_inf, cast=cast)
+		aligner.directionMat = ArrayStateMatrix(kernel.direction)
+		aligner.leftMat = ArrayDirectionalMatrixWrapper(kernel.left_score, kernel.left_extend, kernel.left_ac)
+		aligner.upMat = ArrayDirectionalMatrixWrapper(kernel.up_score, kernel.up_extend, kernel.up_ac)
+	if kernel.top_score is not None:
+		aligner.top_score = cast(kernel.top_score)
+	return alignment
+
+# Whether an array-backed aligner should avoid keeping full matrices
+def _keeps_rows_only(aligner):
+	cells = (len(aligner.seq1.seq) + 1) * (len(aligner.seq2.seq) + 1)
+	return aligner.score_only or (aligner.linear_cells is not None and cells > aligner.linear_cells)
+
+# Needleman-Wunsch using the NumPy-backed kernel; same alignments and scores as
+# NeedlemanWunsch, with typed arrays in place of list-of-lists matrices.
+# If score_only is set only the live DP rows are kept and no alignment is produced.
+# Above linear_cells DP cells the alignment is traced back in linear memory.
+# If band is set only cells within band of the diagonal are filled, widening
+# the band as far as an alignment outside it could still score as high.
+class ArrayNeedlemanWunsch(NeedlemanWunsch):
+	def __init__(self, s1, s2, costs, submat, node_types, composite=0, score_only=False,
+				linear_cells=engine.default_linear_cells, scoring=None, band=None):
+		self.score_only = score_only
+		self.linear_cells = linear_cells
+		self.band = band
+		self.top_score = None
+		super(ArrayNeedlemanWunsch, self).__init__(s1, s2, costs, submat, node_types, composite, scoring)
+
+	def get_top_score(self):
+		return self.top_score
+
+	def get_alignment(self):
+		if self.score_only:
+			return None
+		return super(ArrayNeedlemanWunsch, self).get_alignment()
+
+	def _aligner(self):
+		s1, s2 = self.seq1.seq, self.seq2.seq
+		# Pairs absent from the substitution matrix cannot be matched (their score is -inf)
+		table, codes1, codes2 = self.scoring.table, self.codes1, self.codes2
+		paired1, major1 = self.subtrees1
+		paired2, major2 = self.subtrees2
+		bounds = None
+		if self.band is not None: # cheapest gap of each node, and gain with its best partner present
+			score_bounds = ScoreBounds(self.scoring)
+			gain, gap_vector = score_bounds.gain, score_bounds.gap_vector
+			u1, u2 = numpy.unique(codes1), numpy.unique(codes2)
+			bounds = (gap_vector[codes1], gap_vector[codes2],
+				gain[codes1][:, u2].max(axis=1, initial=0), gain[:, codes2][u1].max(axis=0, initial=0))
+		kernel = engine.TreeAlignmentKernel(
+			self.type_codes1,
+			self.type_codes2,
+			self.scoring.gap_vector[codes1],
+			self.scoring.gap_vector[codes2],
+			paired1, paired2, major1, major2,
+			lambda i: table[codes1[i-1], codes2],
+			lambda i: table[codes2, codes1[i-1]],
+			engine.border_scores(s1, self.composite != 2, self.costs['gap'], self.costs['gapopen']),
+			engine.border_scores(s2, self.composite != 1, self.costs['gap'], self.costs['gapopen']),
+			self.costs['gapopen'],
+			allow_left=self.composite != 2, # If seq2 is composite, can't put gap characters in seq1
+			allow_up=self.composite != 1, # If seq1 is composite, can't put gap characters in seq2
+			score_only=_keeps_rows_only(self),
+			bounds=bounds)
+		alignment = _run_kernel(self, kernel, False, self.scoring.integral)
+		if alignment is None:
+			self.align1, self.align2 = None, None
+		else:
+			self.align1, self.align2 = alignment
+
 # Global alignment of sequence to position weighted matrix, assuming pwm contains sequence
 # This implementation only accepts A,C,T encoding and could be generalized
 class PositionWeightedMatcher():
-	def __init__(self, sequence, pwm, costs, node_types, allow_pwm_gaps=False, use_total=True):
+	def __init__(self, sequence, pwm, costs, node_types, allow_pwm_gaps=False, use_total=True, scoring=None):
+		if scoring is None: # only the costs and node types are used
+			scoring = ScoringScheme({}, costs, node_types)
+		self.scoring = scoring # compiled scoring scheme, shared read-only
 		self.seq1 = sequence
 		#self.seq2 = NeuriteSequence('PWM',pwm.node_type_sequence)
 		self.seq2 = pwm.node_type_sequence
-		self.costs = costs # dictionary of all costs (i.e. penalties)
-		self.pwm = pwm.pwm # position weighted matrix / position specific score matrix: array of {char:weight} dictionary
+		self.costs = scoring.costs # dictionary of all costs (i.e. penalties)
+		self.pwm = pwm # position weighted matrix / position specific score matrix, compiled to arrays
 		self.use_total = use_total
 		self.create_node_types(node_types)
-		self.TADict1 = None
+		self.create_type_codes(node_types)
 		self.allow_pwm_gaps = allow_pwm_gaps
-		if allow_pwm_gaps:
-			self.TADict1 = create_ta_dictionary(self.seq1.seq, node_types, gap_cost=costs['gap'])
-		self.TADict2 = create_ta_dictionary(self.seq2.seq, node_types, gap_cost=costs['gap'])
+		self.create_subtree_index(node_types, scoring.pwm_gap_costs)
+		self.create_weights()
 		if use_total:
 			self.get_score = self.get_weight
 		else:
@@ -593,12 +1412,36 @@ class PositionWeightedMatcher():
 			for residue in node_types[node_type]:
 				self.node_types[residue] = node_type
 
+	# Node type codes per position, from the sequence's cached encoding and the pwm
+	def create_type_codes(self,node_types):
+		self.type_codes1 = self.seq1.get_type_codes(node_types)
+		self.type_codes2 = self.pwm.type_codes
+		self.types1 = self.type_codes1.tolist()
+		self.types2 = self.type_codes2.tolist()
+
+	# Paired A positions and subtree gap costs per position, from the sequences' cached subtree indices;
+	# the sequence only needs one if it may be gapped
+	def create_subtree_index(self,node_types,gap_costs):
+		self.subtrees1 = None
+		if self.allow_pwm_gaps:
+			self.subtrees1 = self.seq1.get_subtree_index(node_types, gap_costs)
+			self.paired1, self.major1 = [index.tolist() for index in self.subtrees1]
+		self.subtrees2 = self.seq2.get_subtree_index(node_types, gap_costs)
+		self.paired2, self.major2 = [index.tolist() for index in self.subtrees2]
+
+	# Weights per position as lists, the total and that of each residue (by pwm index)
+	def create_weights(self):
+		cast = int if self.pwm.integral else float
+		self.totals = [cast(weight) for weight in self.pwm.totals.tolist()]
+		self.weight_rows = [[cast(weight) for weight in row] for row in self.pwm.weights.tolist()]
+		self.residue_index = self.pwm.index.tolist()
+
 	def get_char_weight(self,position, char1):
-		return self.pwm[position][char1]
+		return self.weight_rows[position][self.residue_index[ord(char1)]]
 
 	# char1 is ignored and only used so that it takes the same parameters as get_char_weight
 	def get_weight(self,position, char1='total'):
-		return self.pwm[position]['total']
+		return self.totals[position]
 		
 	# return top (highest) alignment score given sequence 1 and 2
 	def get_top_score(self):
@@ -634,11 +1477,16 @@ class PositionWeightedMatcher():
 		return scoreExtendPair
 		
 	# Calculates the gap cost in a given direction from a given position, which depends on the node type
-	def calculate_gap(self,i,j,seq1,seq2,m,directionM,dirScoreM,TADict,gap_direction):
+	def calculate_gap(self,i,j,seq1,seq2,m,directionM,dirScoreM,subtrees,gap_direction):
 		isExtend = False
 		a_c_match = False
+		if gap_direction == 1:
+			types1, types2 = self.types1, self.types2
+		else:
+			types1, types2 = self.types2, self.types1
+		paired, major = subtrees
 		# CType: gap one
-		if self.node_types[seq1[i-1]] == 'C':
+		if types1[i-1] == type_c:
 			# The prior position assuming a gap (index based on m)
 			gapPosi = i - 1
 			gapPosj = j
@@ -652,13 +1500,13 @@ class PositionWeightedMatcher():
 														gap_direction)
 
 		# T-type: gap until paired A
-		elif self.node_types[seq1[i-1]] == 'T': 
+		elif types1[i-1] == type_t:
 			# The prior position assuming a gap (index based on m)
-			gapPosi = TADict[i-1]
+			gapPosi = paired[i-1]
 			# Case where this is the last T; handle sentinal and get cost of front-gap
-			if TADict[i-1] is -1:
+			if paired[i-1] == -1:
 				gapPosi = 0
-			gapCostMajor = TADict[str(i-1)] # Cost of the gap from the T-node up to the A-node
+			gapCostMajor = major[i-1] # Cost of the gap from the T-node up to the A-node
 			gapCostStart = self.costs['gap'] # Cost of the A-node that starts the gap
 
 			# Calculate the total gap cost assuming the associated A is also gapped
@@ -671,8 +1519,8 @@ class PositionWeightedMatcher():
 																gap_direction)
 
 			# If seq2 character is C-type, determine whether to match T-paired A and C, or to just gap the A
-			# This will not happen if this is the last T (TADict[i-1] is -1), as the whole sequence must be gapped
-			if self.node_types[seq2[j-1]] == 'C' and TADict[i-1] is not -1:
+			# This will not happen if this is the last T (paired[i-1] is -1), as the whole sequence must be gapped
+			if types2[j-1] == type_c and paired[i-1] != -1:
 				# Calculate the total gap cost assuming the associated A-node matches a C-node
 				if gap_direction == 1:
 					ACScore = self.get_score(j-1,seq1[gapPosi])
@@ -750,9 +1598,10 @@ class PositionWeightedMatcher():
 		for i in range(1, l1+1): # per base-pair in sequence 1 ...
 			for j in range(1, l2+1): # per base-pair in sequence 2, align them
 				#print(str(i)+" "+str(j)+ " of "+str(l1)+" " +str(l2))
-				if (self.node_types[self.seq1.seq[i-1]] == 'C' and self.node_types[self.seq2.seq[j-1]] == 'A') or (self.node_types[self.seq1.seq[i-1]] == 'A' and self.node_types[self.seq2.seq[j-1]] == 'C'):
+				type1, type2 = self.types1[i-1], self.types2[j-1]
+				if (type1 == type_c and type2 == type_a) or (type1 == type_a and type2 == type_c):
 					score = None # no match if one is a C type and the other is an A type
-				elif (self.node_types[self.seq1.seq[i-1]] == 'T') ^ (self.node_types[self.seq2.seq[j-1]] == 'T'):
+				elif (type1 == type_t) ^ (type2 == type_t):
 					score = None # no match if one is a T type and the other is not
 				elif self.scoreMat.get_data(i-1,j-1) is None:
 					score = None # Diagonal is an unreachable position due to composite
@@ -769,7 +1618,7 @@ class PositionWeightedMatcher():
 										self.scoreMat,
 										self.directionMat,
 										self.leftMat,
-										self.TADict1,
+										(self.paired1, self.major1),
 										1)
 
 				# Cost for gapping up (over sequence 2)
@@ -780,7 +1629,7 @@ class PositionWeightedMatcher():
 								  self.scoreMat.T,
 								  self.directionMat.T,
 								  self.upMat.T,
-								  self.TADict2,
+								  (self.paired2, self.major2),
 								  2)
 				
 				
@@ -820,10 +1669,10 @@ class PositionWeightedMatcher():
 			# if score is a gap in sequence 2 (direction is 1), only walk back on i
 			if keepGapping == 1 or keepGapping == 0 and self.directionMat.get_data(i,j) == 1:
 				# If the node being gapped is a T-node, appropriately gap the entire subtree
-				if self.node_types[self.seq1.seq[i-1]] == 'T':
+				if self.types1[i-1] == type_t:
 					# Get i_target and j_target depending on whether "forced" gapping or not
 					if keepGapping == 1:
-						i_target = self.TADict1[i-1]
+						i_target = self.paired1[i-1]
 						if self.leftMat.a_c_match.get_data(i,j) == True:
 							j_target = j-1
 						else:
@@ -859,14 +1708,14 @@ class PositionWeightedMatcher():
 				
 			# if score is a gap in sequence 1 (direction is 2), only walk back on j
 			elif keepGapping == 2 or keepGapping == 0 and self.directionMat.get_data(i,j) == 2:
-				if self.node_types[self.seq2.seq[j-1]] == 'T':
+				if self.types2[j-1] == type_t:
 					# Get i_target and j_target depending on whether "forced" gapping or not
 					if keepGapping == 2:
 						if self.upMat.a_c_match.get_data(i,j) == True:
 							i_target = i-1
 						else:
 							i_target = i
-						j_target = self.TADict2[j-1]
+						j_target = self.paired2[j-1]
 					else:
 						i_target = self.backPos[i,j][0]
 						j_target = self.backPos[i,j][1]
@@ -918,6 +1767,70 @@ class PositionWeightedMatcher():
 		self.align = self.align[::-1]
 		self.pwm_align = self.pwm_align[::-1]
 
+# PositionWeightedMatcher using the NumPy-backed kernel. Above linear_cells DP
+# cells the alignment is traced back in linear memory; band as for
+# ArrayNeedlemanWunsch.
+class ArrayPositionWeightedMatcher(PositionWeightedMatcher):
+	def __init__(self, sequence, pwm, costs, node_types, allow_pwm_gaps=False, use_total=True,
+				linear_cells=engine.default_linear_cells, scoring=None, band=None):
+		self.score_only = False
+		self.linear_cells = linear_cells
+		self.band = band
+		self.top_score = None
+		super(ArrayPositionWeightedMatcher, self).__init__(sequence, pwm, costs, node_types,
+														allow_pwm_gaps, use_total, scoring)
+
+	def get_top_score(self):
+		return self.top_score
+
+	# The kernel reads the weights from the compiled pwm
+	def create_weights(self):
+		pass
+
+	def _aligner(self):
+		s1, s2 = self.seq1.seq, self.seq2.seq
+		if self.use_total:
+			weights = self.pwm.totals
+			match_row = lambda i: weights
+			weight_rows, row_of = weights[None, :], numpy.zeros(len(s1), dtype=numpy.intp)
+		else:
+			codes1 = self.pwm.index[self.seq1.get_residue_codes()]
+			columns = numpy.ascontiguousarray(self.pwm.weights.T) # residue => weight per position
+			match_row = lambda i: columns[codes1[i-1]]
+			present, row_of = numpy.unique(codes1, return_inverse=True)
+			weight_rows = columns[present] # weights of the residues of the sequence
+		if self.allow_pwm_gaps:
+			paired1, major1 = self.subtrees1
+		else: # the sequence is never gapped, so has no subtrees to jump
+			paired1, major1 = numpy.full(len(s1), -1), numpy.zeros(len(s1))
+		paired2, major2 = self.subtrees2
+		gap, gapopen = self.scoring.gap, self.scoring.gapopen
+		bounds = None
+		if self.band is not None: # gain of each node with its best partner
+			gain = numpy.maximum(weight_rows - 2 * gap, 0)
+			bounds = (numpy.full(len(s1), gap), numpy.full(len(s2), gap),
+				gain.max(axis=1, initial=0)[row_of], gain.max(axis=0, initial=0))
+		kernel = engine.TreeAlignmentKernel(
+			self.type_codes1,
+			self.type_codes2,
+			numpy.full(len(s1), gap, dtype=float),
+			numpy.full(len(s2), gap, dtype=float),
+			paired1, paired2, major1, major2,
+			match_row, match_row,
+			engine.border_scores(s1, self.allow_pwm_gaps, gap, gapopen),
+			engine.border_scores(s2, True, gap, gapopen),
+			gapopen,
+			allow_left=self.allow_pwm_gaps, # Only gap the pwm if gaps in pwm are allowed
+			allow_up=True,
+			score_only=_keeps_rows_only(self),
+			bounds=bounds)
+		integral = self.pwm.integral and all(isinstance(v, int) for v in self.costs.values())
+		self.align, self.pwm_align = _run_kernel(self, kernel, True, integral)
+
+# Alignment engines selectable with -engine; 'list' is the reference implementation
+aligners = {'list': NeedlemanWunsch, 'array': ArrayNeedlemanWunsch}
+matchers = {'list': PositionWeightedMatcher, 'array': ArrayPositionWeightedMatcher}
+
 class LocalAlignmentWrapper():
 	def __init__(self, s1, s2, align1, align2, score, start1=None, start2=None, end1=None, end2=None):
 		self.s1 = s1
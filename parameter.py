@@ -4,6 +4,8 @@ from Bio.SubsMat import MatrixInfo
 from Bio import SeqIO
 from sequence import NeuriteSequence
 import sequence
+from scoring import ScoringScheme
+from cache import AlignmentCache, default_cache_size
 from random import shuffle
 
 class DomainArgumentValidator():
@@ -52,7 +54,10 @@ class AlignmentArgumentValidator():
     # Checks user-provided arguments are valid
     def check_args(self):
         return all([self.test_num_workers(),
-                self.test_valid_matrix(), self.test_threshold()])
+                self.test_valid_matrix(), self.test_threshold(),
+                self.test_band(), self.test_task_fraction(),
+                self.test_output_format(), self.test_hits(), self.test_prefilter(),
+                self.test_refine_tol()])
 
     # Test a valid substitution matrix is selected
     def test_valid_matrix(self):
@@ -77,6 +82,65 @@ class AlignmentArgumentValidator():
         else:
             raise IOError('Consensus threshold (thresh) must be positive')
 
+    # Test that a banded alignment has a valid band and engine
+    def test_band(self):
+        if self.args['band'] is None:
+            return True
+        elif self.args['band'] < 0:
+            raise IOError('Band (band) must be non-negative')
+        elif self.args['engine'] != 'array':
+            raise IOError('Banded alignment (band) requires the array engine')
+        else:
+            return True
+
+    # Test that the task fraction is a proportion
+    def test_task_fraction(self):
+        if not 'task_fraction' in self.args.keys() or 0 < self.args['task_fraction'] <= 1:
+            return True
+        else:
+            raise IOError('Task fraction (task_fraction) must be in (0,1]')
+
+    # Test that a resumed run writes text scores
+    def test_output_format(self):
+        if 'o_format' in self.args.keys() and self.args['o_format'] == 'npy' \
+            and 'resume' in self.args.keys() and self.args['resume']:
+            raise IOError('Resume (resume) requires the tab output format (o_format)')
+        else:
+            return True
+
+    # Test that top hits are valid and written as a text edge list
+    def test_hits(self):
+        topk = self.args['topk'] if 'topk' in self.args.keys() else None
+        min_score = self.args['min_score'] if 'min_score' in self.args.keys() else None
+        if topk is None and min_score is None:
+            return True
+        elif topk is not None and topk < 1:
+            raise IOError('Number of top hits (topk) must be >= 1')
+        elif self.args['o_format'] != 'tab' or self.args['shard_output'] or self.args['resume']:
+            raise IOError('Top hits (topk, min_score) are written as a tab edge list, without o_format npy, shard_output or resume')
+        else:
+            return True
+
+    # Test that the prefilter has a valid k and sensitivity, and hits to filter
+    def test_prefilter(self):
+        if not 'prefilter' in self.args.keys() or self.args['prefilter'] is None:
+            return True
+        elif not 0 <= self.args['prefilter'] <= 1:
+            raise IOError('Prefilter sensitivity (prefilter) must be in [0,1]')
+        elif self.args['prefilter_k'] < 1:
+            raise IOError('Prefilter k-mer length (prefilter_k) must be >= 1')
+        elif self.args['topk'] is None and self.args['min_score'] is None:
+            raise IOError('The prefilter (prefilter) requires topk or min_score')
+        else:
+            return True
+
+    # Test that the MSA refinement tolerance is not negative
+    def test_refine_tol(self):
+        if not 'refine_tol' in self.args.keys() or self.args['refine_tol'] is None or self.args['refine_tol'] >= 0:
+            return True
+        else:
+            raise IOError('Refinement tolerance (refine_tol) must be >= 0')
+
 # Helper-class to parse input arguments
 class AlignmentCommandParser():
     def __init__(self):
@@ -109,6 +173,9 @@ class AlignmentCommandParser():
         
         param_local.add_argument('-gapopen', metavar='INT', default=0, type=int,
                     help='Gap open penalty [0]')
+
+        param_local.add_argument('-band', metavar='INT', default=None, type=int,
+                    help='Only fill DP cells within INT of the diagonal, widening the band as needed; array engine only [na]')
         
         # MSA specific parameters
         param_msa.add_argument('-thresh', metavar='FLOAT', default=0.7, type=float, 
@@ -123,6 +190,12 @@ class AlignmentCommandParser():
 
         param_msa.add_argument('-iterate', metavar='FLOAT', default=1, type=float,
                     help='Number of MSA iterations (using a PWM) or threshold for change in 40% composite score to continue iterating [1]')
+
+        param_msa.add_argument('--msa_debug', action='store_const', const=True, default=False,
+                    help='Keep the matcher of each MSA query alignment, with its full DP matrices [False]')
+
+        param_msa.add_argument('-refine_tol', metavar='FLOAT', default=None, type=float,
+                    help='On MSA iterations after the first, only realign queries with an aligned column whose PWM weight changed by more than FLOAT of the number of queries [na]')
         
         param_opts.add_argument('-subsample', metavar='FLOAT', default=1, type=float, 
                     help='Subsample of data, taking the first n sequences. Value treated as proportion of total if (0,1] and explicit number for [2,N].')
@@ -149,11 +222,52 @@ class AlignmentCommandParser():
         param_opts.add_argument('-n', metavar='INT', default=2, type=int,
                     help='Number of worker processes [2]')
         
+        param_opts.add_argument('-engine', metavar='STR', default='array',
+                    choices=['array', 'list'],
+                    help='Alignment engine {array, list} [array]')
+
+        param_opts.add_argument('-linear_cells', metavar='INT', default=4000000, type=int,
+                    help='DP cells above which the array engine traces alignments back in linear memory [4000000]')
+
+        param_opts.add_argument('-task_fraction', metavar='FLOAT', default=0.01, type=float,
+                    help='Largest share of the total work in one pairwise task; longer targets are split across tasks [0.01]')
+        
         param_opts.add_argument('-o', metavar='FILE', default='./scores.tab', 
                     help='File to write/append output [./scores.tab]')
+
+        param_opts.add_argument('-o_format', metavar='STR', default='tab',
+                    choices=['tab', 'npy'],
+                    help='Score output format {tab, npy}; npy is a float32 matrix with a FILE.names index [tab]')
         
         param_opts.add_argument('-a', metavar='FILE', default=None, 
                     help='File to write/append alignments [na]')
+
+        param_opts.add_argument('-topk', metavar='INT', default=None, type=int,
+                    help='Only output the INT best scoring queries of each target, as an edge list [na]')
+
+        param_opts.add_argument('-min_score', metavar='FLOAT', default=None, type=float,
+                    help='Only output queries scoring at least FLOAT, as an edge list [na]')
+
+        param_opts.add_argument('-prefilter', metavar='FLOAT', default=None, type=float,
+                    help='With topk or min_score, skip pairs sharing less than FLOAT of their node type k-mers [na]')
+
+        param_opts.add_argument('-prefilter_k', metavar='INT', default=3, type=int,
+                    help='Length of the node type k-mers of the prefilter [3]')
+
+        param_opts.add_argument('--prefilter_audit', action='store_const', const=True, default=False,
+                    help='Align the pairs the prefilter skips too, and report the hits it would have missed.')
+
+        param_opts.add_argument('--resume', action='store_const', const=True, default=False,
+                    help='Keep the complete rows of existing output files and only align the missing targets.')
+
+        param_opts.add_argument('--shard_output', action='store_const', const=True, default=False,
+                    help='Workers write their results to their own files, merged into the output files at the end.')
+
+        param_opts.add_argument('-cache', metavar='FILE', default=None,
+                    help='Persistent alignment cache (sqlite) reused across runs with the same scoring [na]')
+
+        param_opts.add_argument('-cache_size', metavar='INT', default=default_cache_size, type=int,
+                    help='Alignments kept in the cache before the least recently used are evicted [1000000]')
         
         param_opts.add_argument('-h','--help', action='help',
                     help='Show this help screen and exit')
@@ -244,6 +358,22 @@ class DomainCommandParser():
 
         param_msa.add_argument('-iterate', metavar='FLOAT', default=1, type=float,
                     help='Number of MSA iterations (using a PWM) or threshold for change in 40% composite score to continue iterating [1]')
+
+        param_msa.add_argument('-refine_tol', metavar='FLOAT', default=None, type=float,
+                    help='On MSA iterations after the first, only realign queries with an aligned column whose PWM weight changed by more than FLOAT of the number of queries [na]')
+
+        param_msa.add_argument('-engine', metavar='STR', default='array',
+                    choices=['array', 'list'],
+                    help='Alignment engine {array, list} [array]')
+
+        param_msa.add_argument('-linear_cells', metavar='INT', default=4000000, type=int,
+                    help='DP cells above which the array engine traces alignments back in linear memory [4000000]')
+
+        param_msa.add_argument('-cache', metavar='FILE', default=None,
+                    help='Persistent alignment cache (sqlite) reused across runs with the same scoring [na]')
+
+        param_msa.add_argument('-cache_size', metavar='INT', default=default_cache_size, type=int,
+                    help='Alignments kept in the cache before the least recently used are evicted [1000000]')
         
         param_opts.add_argument('--overlap', action='store_const', const=True, default=False,
                     help='Allow query and baseline sets to contain the same sequences. If false, remove overlapping sequences from baseline set [False]')
@@ -306,6 +436,8 @@ class InputWrapperState():
     def __init__(self, args):
         self.args = args # reference user-provided arguments
         self.subsmat = None # references data for substitution matrix
+        self.scoring = None # references the compiled scoring scheme
+        self.cache = None # references the alignment cache
         self.fname = args['f'] # input filename
         self.fname2 = args['f2'] # input filename
         self.alignment_file = args['a']
@@ -323,6 +455,23 @@ class InputWrapperState():
     def get_node_types(self):
         return self.node_types       
 
+    # Get the alignment engine; 'array' (NumPy-backed) unless 'list' is requested
+    def get_engine(self):
+        if 'engine' in self.args.keys() and self.args['engine'] is not None:
+            return self.args['engine']
+        return 'array'
+
+    # Get keyword arguments for the aligners of the selected engine
+    def get_engine_options(self):
+        if self.get_engine() != 'array':
+            return {}
+        options = {}
+        if 'linear_cells' in self.args.keys() and self.args['linear_cells'] is not None:
+            options['linear_cells'] = self.args['linear_cells']
+        if 'band' in self.args.keys() and self.args['band'] is not None:
+            options['band'] = self.args['band']
+        return options
+
     # Get arguments relative to penalties
     def get_penalties(self):
         cost_ids = ('gap','gapopen') # all possible costs, might in the future include a separate gap open and gap extension cost
@@ -331,6 +480,21 @@ class InputWrapperState():
     # Get the substitution matrix which will be used
     def get_submatrix(self):
         return self.subsmat
+
+    # Get the costs, substitution matrix and node types compiled for alignment; built once
+    def get_scoring_scheme(self):
+        if self.scoring is None:
+            self.scoring = ScoringScheme(self.get_submatrix(), self.get_penalties(), self.node_types)
+        return self.scoring
+        
+    # Get the persistent alignment cache, or None if none is requested; opened once
+    def get_alignment_cache(self):
+        if self.cache is None and 'cache' in self.args.keys() and self.args['cache'] is not None:
+            max_entries = default_cache_size
+            if 'cache_size' in self.args.keys() and self.args['cache_size'] is not None:
+                max_entries = self.args['cache_size']
+            self.cache = AlignmentCache(self.args['cache'], self.get_scoring_scheme(), self.get_engine(), max_entries)
+        return self.cache
         
     # Trivial function to parse a fasta file
     def parse_fasta(self, fname):
@@ -338,6 +502,7 @@ class InputWrapperState():
         queries = [] # references list of parsed sequences
         for i in parsed_fasta: # cast as a neuronal sequence; easy modeling.
             s = NeuriteSequence(seq=str(i.seq), name=i.name)
+            s.encode(self.node_types) # cache residue and node type codes
             queries.append(s)
         print(str(len(queries)) + ' queries parsed [OK]')
         return queries # return set of fasta entries
@@ -0,0 +1,242 @@
+'''
+Compiled scoring parameters for the alignment engines. A ScoringScheme is
+built once per run from the substitution matrix, gap costs and node types,
+and is only read thereafter, so it can be shared with worker processes.
+@author: Todd Gillette and Parsa Hosseini
+'''
+
+import numpy
+import sequence
+from engine import neg_inf
+
+def residue_gap_costs(node_types, submatrix=None, gap_cost=-1):
+    '''
+    Creates a dictionary of the cost of gapping each residue, as given by the
+    (residue, '-') entries of the substitution matrix. Node types without an
+    entry cost gap_cost.
+    '''
+    gap_costs = {}
+    if submatrix is not None:
+        for pair in submatrix.keys():
+            if pair[1] == '-' and pair[0] != '-':
+                gap_costs[pair[0]] = submatrix[pair]
+    for nodetype in node_types:
+        if not nodetype in gap_costs:
+            gap_costs[nodetype] = gap_cost
+    return gap_costs
+
+# Fills in all gap-residue pairs either with flipped order entry if it exists, else with the default gap cost
+# Also fills in flipped residue-residue scores
+def fill_residue_specific_gapcost(submat, gap_cost):
+    newToSubmat = {}
+    for pair in submat.keys():
+        if pair[0] == '-' and pair[1] == '-':
+            # do nothing, this is useless and shouldn't happen
+            pass
+        elif pair[0] == '-' or pair[1] == '-':
+            # Note that the given residue has an associated gap cost
+            if pair[0] == '-' and (pair[1],'-') not in submat.keys():
+                newToSubmat[pair[1],'-'] = submat[pair]
+            elif pair[1] == '-' and (pair[1],'-') not in submat.keys():
+                newToSubmat[pair[1],'-'] = submat[pair]
+        else:
+            # Fill the residueDict so none are missed
+            if (pair[0],'-') not in submat.keys() and ('-',pair[0]) not in submat.keys():
+                newToSubmat[pair[0],'-'] = gap_cost
+                newToSubmat['-',pair[0]] = gap_cost
+            if (pair[1],'-') not in submat.keys() and ('-',pair[1]) not in submat.keys():
+                newToSubmat[pair[1],'-'] = gap_cost
+                newToSubmat['-',pair[1]] = gap_cost
+            if (pair[1],pair[0]) not in submat.keys():
+                newToSubmat[pair[1],pair[0]] = submat[pair]
+    for pair in newToSubmat.keys():
+        submat[pair] = newToSubmat[pair]
+
+class ScoringScheme():
+    '''
+    A substitution matrix, gap costs and node types compiled for alignment.
+    Residues are indexed into a dense residue-by-residue score table and a
+    gap cost vector, held both as numpy arrays (missing scores are -inf) and
+    as lists of the original numbers (missing scores are None).
+    @param submat: substitution matrix dictionary; it is not modified.
+    @param costs: dictionary of 'gap' and 'gapopen' costs.
+    @param node_types: dictionary of node type to residue characters.
+    '''
+    def __init__(self, submat, costs, node_types=sequence.default_nodetypes):
+        self.costs = dict(costs)
+        self.gap = costs['gap']
+        self.gapopen = costs['gapopen']
+        self.node_types = node_types
+        self.submat = dict(submat) # completed with gap and flipped entries
+        fill_residue_specific_gapcost(self.submat, self.gap)
+        self.gap_costs = residue_gap_costs(node_types, self.submat, self.gap)
+        # Gap costs used when matching to a position weighted matrix
+        self.pwm_gap_costs = residue_gap_costs(node_types, gap_cost=self.gap)
+
+        residues = set(self.gap_costs.keys())
+        for pair in self.submat.keys():
+            residues.update(pair)
+        residues.discard('-')
+        self.residues = sorted(residues)
+        # Residue code to table index; residues outside the matrix get len(self.residues)
+        self.index = numpy.full(256, len(self.residues), dtype=numpy.intp)
+        for n, residue in enumerate(self.residues):
+            self.index[ord(residue)] = n
+        self.score_lists = [[self.submat.get((a, b)) for b in self.residues] for a in self.residues]
+        self.gap_list = [self.gap_costs.get(a) for a in self.residues]
+        self.table = numpy.array([[neg_inf if score is None else score for score in row]
+                                  for row in self.score_lists], dtype=float).reshape(len(self.residues), len(self.residues))
+        self.gap_vector = numpy.array([neg_inf if cost is None else cost for cost in self.gap_list], dtype=float)
+        # Whether swapping the sequences gives the same scores
+        self.symmetric = bool((self.table == self.table.T).all())
+        # Whether all scores are integers, in which case so are alignment scores
+        self.integral = all(isinstance(v, int) for v in list(self.submat.values()) + list(self.costs.values()))
+
+    def encode(self, seq):
+        '''
+        Indexes the residues of a sequence into the score table and gap cost vector.
+        @param seq: NeuriteSequence.
+        @return: intp numpy array.
+        '''
+        codes = self.index[seq.get_residue_codes()]
+        if (codes == len(self.residues)).any():
+            unknown = sorted(set(seq.seq) - set(self.residues))
+            raise IOError('Residues ' + ''.join(unknown) + ' of ' + seq.name +
+                          ' are not in the substitution matrix')
+        return codes
+
+class ScoreBounds():
+    '''
+    Bounds on the alignment of two sequences from their residue composition
+    alone. Any alignment scores at most the cost of gapping every residue,
+    leading gaps and subtree gaps included, plus, for each matched pair, the
+    gain of matching rather than gapping both; only pairs of node types the
+    alignment can match are counted. Ignoring the order of the
+    residues, the matched pairs are bounded by pairing each residue with the
+    best partner present in the other sequence.
+    @param scoring: ScoringScheme.
+    '''
+    def __init__(self, scoring):
+        self.scoring = scoring
+        num_residues = len(scoring.residues)
+        # leading gaps cost the default gap cost whatever the residue
+        self.gap_vector = numpy.maximum(scoring.gap_vector, scoring.gap)
+        self.finite = bool(numpy.isfinite(self.gap_vector).all())
+        # pairs that can be matched: scored, and of the same node type, or an A-node and a
+        # C-node (matched as the subtree of the A-node is gapped); T-nodes only match T-nodes
+        types = sequence.node_type_lookup(scoring.node_types)[sequence.encode_residues(''.join(scoring.residues))]
+        same_type = types[:, None] == types[None, :]
+        a_c = numpy.isin(types, [sequence.type_a, sequence.type_c])
+        self.compatible = (scoring.table > neg_inf) & (same_type | (a_c[:, None] & a_c[None, :]))
+        # gain of matching a pair rather than gapping both, if positive
+        with numpy.errstate(invalid='ignore'):
+            gain = scoring.table - self.gap_vector[:, None] - self.gap_vector[None, :]
+        self.gain = numpy.where(self.compatible & numpy.isfinite(gain), numpy.maximum(gain, 0), 0).reshape(num_residues, num_residues)
+        self.compositions = {} # seq => residue counts
+        self.matches = {} # pair of compositions => max_matches
+
+    def composition(self, seq):
+        '''
+        Counts the residues of a sequence, indexed as the score table; a last
+        entry counts residues outside the substitution matrix.
+        @param seq: NeuriteSequence.
+        @return: int64 numpy array.
+        '''
+        counts = self.compositions.get(seq.seq)
+        if counts is None:
+            codes = self.scoring.index[seq.get_residue_codes()]
+            counts = numpy.bincount(codes, minlength=len(self.scoring.residues) + 1)
+            self.compositions[seq.seq] = counts
+        return counts
+
+    def score_bounds(self, seq1, queries):
+        '''
+        Upper bounds of the score of aligning seq1 to each query.
+        @param seq1: NeuriteSequence.
+        @param queries: list of NeuriteSequences.
+        @return: float numpy array; inf where no bound is known.
+        '''
+        counts1 = self.composition(seq1)
+        counts2 = numpy.array([self.composition(query) for query in queries], dtype=numpy.int64).reshape(len(queries), -1)
+        if not self.finite or counts1[-1] > 0:
+            return numpy.full(len(queries), numpy.inf)
+        counts1, unknown, counts2 = counts1[:-1], counts2[:, -1], counts2[:, :-1]
+        gapped = counts1.dot(self.gap_vector) + counts2.dot(self.gap_vector) # score with every residue gapped
+        # each residue of seq1 paired with its best partner present in the query, and vice versa
+        present1, present2 = counts1 > 0, counts2 > 0
+        best1 = numpy.where(present2[:, None, :], self.gain[None, :, :], 0).max(axis=2, initial=0)
+        best2 = numpy.where(present1[:, None], self.gain, 0).max(axis=0, initial=0)
+        gain = numpy.minimum(best1.dot(counts1), counts2.dot(best2))
+        bounds = gapped + gain
+        if self.scoring.gapopen > 0: # at most one gap opening per gapped node
+            lengths = counts1.sum() + counts2.sum(axis=1)
+            bounds = bounds + lengths * self.scoring.gapopen
+        bounds = bounds.astype(float)
+        bounds[unknown > 0] = numpy.inf
+        return bounds
+
+    def max_matches(self, seq1, seq2):
+        '''
+        Upper bound of the number of matched pairs of any alignment of two
+        sequences: the largest matching of their residues into pairs the
+        substitution matrix scores, found as a maximum flow between residue counts.
+        @return: integer.
+        '''
+        counts1, counts2 = self.composition(seq1)[:-1], self.composition(seq2)[:-1]
+        key = (counts1.tobytes(), counts2.tobytes())
+        if key not in self.matches:
+            self.matches[key] = self._max_flow(counts1, counts2)
+        return self.matches[key]
+
+    def _max_flow(self, counts1, counts2):
+        rows, cols = numpy.flatnonzero(counts1), numpy.flatnonzero(counts2)
+        supply = {a: int(counts1[a]) for a in rows}
+        demand = {b: int(counts2[b]) for b in cols}
+        partners = {a: [b for b in cols if self.compatible[a, b]] for a in rows}
+        flow = {} # (a, b) => residues of a matched to b
+        matches = 0
+        while True:
+            # breadth-first search for an augmenting path from spare a to spare b
+            parent = {('a', a): None for a in rows if supply[a] > 0}
+            queue = list(parent.keys())
+            end = None
+            while queue and end is None:
+                node = queue.pop(0)
+                if node[0] == 'a':
+                    for b in partners[node[1]]:
+                        if ('b', b) not in parent:
+                            parent[('b', b)] = node
+                            if demand[b] > 0:
+                                end = ('b', b)
+                                break
+                            queue.append(('b', b))
+                else: # back along a matched pair
+                    for a in rows:
+                        if flow.get((a, node[1]), 0) > 0 and ('a', a) not in parent:
+                            parent[('a', a)] = node
+                            queue.append(('a', a))
+            if end is None:
+                return matches
+            path = [end]
+            while parent[path[-1]] is not None:
+                path.append(parent[path[-1]])
+            path.reverse()
+            amount = min(supply[path[0][1]], demand[end[1]])
+            for n in range(1, len(path), 2):
+                if n + 1 < len(path): # b back to a reduces a matched pair
+                    amount = min(amount, flow[(path[n + 1][1], path[n][1])])
+            for n in range(0, len(path) - 1):
+                if path[n][0] == 'a':
+                    flow[(path[n][1], path[n + 1][1])] = flow.get((path[n][1], path[n + 1][1]), 0) + amount
+                else:
+                    flow[(path[n + 1][1], path[n][1])] -= amount
+            supply[path[0][1]] -= amount
+            demand[end[1]] -= amount
+            matches += amount
+
+    def min_gaps(self, seq1, seq2):
+        '''
+        Lower bound of the number of gap characters of any alignment of two sequences.
+        @return: integer.
+        '''
+        return len(seq1.seq) + len(seq2.seq) - 2 * self.max_matches(seq1, seq2)
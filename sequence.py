@@ -3,8 +3,17 @@ Provides the ability to model and represent various concrete objects that
 are to be used throughout application runtime.
 '''
 
+import numpy
+
 default_nodetypes = {'A':'A','C':'C','T':'T'}
 
+# Integer codes for node types, as held in encoded sequences; residues of no
+# known node type (such as gaps) are coded as no_type
+type_a, type_c, type_t = 0, 1, 2
+no_type = -1
+gap_code = ord('-') # residue code of a gap
+node_type_codes = {'A': type_a, 'C': type_c, 'T': type_t}
+
 # Reads in a file containing node types (A,C,T) and a string of specific characters of that type
 # Format for a given line should be: "<node-type>:<character string>", for example: "C:BRPD", or the simple case: "C:C"
 def parse_node_types(fname):
@@ -33,6 +42,89 @@ def generate_identity_matrix(nodetypes=default_nodetypes):
                 submat[(char2,char1)] = -40
     return submat
 
+def encode_residues(seq):
+    '''
+    Encodes a sequence string as an array of residue codes (the residue's byte value).
+    @param seq: sequence string.
+    @return: uint8 numpy array.
+    '''
+    return numpy.frombuffer(seq.encode('ascii'), dtype=numpy.uint8)
+
+def node_type_lookup(node_types=default_nodetypes):
+    '''
+    Builds a table mapping each residue code to its node type code.
+    @param node_types: dictionary of node type to residue characters.
+    @return: int8 numpy array of length 256.
+    '''
+    lookup = numpy.full(256, no_type, dtype=numpy.int8)
+    for node_type in node_types.keys():
+        for residue in node_types[node_type]:
+            lookup[ord(residue)] = node_type_codes[node_type]
+    return lookup
+
+def encode_node_types(seq, node_types=default_nodetypes):
+    '''
+    Encodes a sequence string as an array of node type codes.
+    @param seq: sequence string.
+    @param node_types: dictionary of node type to residue characters.
+    @return: int8 numpy array.
+    '''
+    return node_type_lookup(node_types)[encode_residues(seq)]
+
+def subtree_index(type_codes, gap_costs):
+    '''
+    Links each T-node to its paired A-node and totals the cost of gapping the
+    subtree from the node after the A-node up to the T-node.
+    @param type_codes: list of node type codes of the sequence.
+    @param gap_costs: list of gap costs of the residues of the sequence.
+    @return: paired A position per position (-1 where there is none, including
+    the T-node closing the whole tree) and subtree gap cost per position (0
+    for other than T-nodes), as numpy arrays.
+    '''
+    paired = [-1] * len(type_codes)
+    costs = [0] * len(type_codes)
+    a_stack = [-1] # Begin the stack with a sentinal value
+    cost_stack = [0]
+    for index in range(len(type_codes)):
+        # Add the cost of the current node to the current gap cost register
+        cost_stack[-1] += gap_costs[index]
+        if type_codes[index] == type_a:
+            a_stack.append(index)
+            cost_stack.append(0) # push on a new gap cost register
+        elif type_codes[index] == type_t:
+            paired[index] = a_stack.pop()
+            costs[index] = cost_stack.pop()
+            # Add the cost to the enclosing A-T pair
+            if len(cost_stack) > 0:
+                cost_stack[-1] += costs[index]
+    integral = all(isinstance(cost, int) for cost in gap_costs)
+    return numpy.array(paired, dtype=numpy.int64), \
+        numpy.array(costs, dtype=numpy.int64 if integral else numpy.float64)
+
+def kmer_counts(type_codes, k):
+    '''
+    Counts the k-mers of node types of a sequence; k-mers including a
+    residue of no node type are not counted.
+    @param type_codes: numpy array of node type codes of the sequence.
+    @param k: k-mer length.
+    @return: int32 numpy array of the count of each of the 3**k k-mers.
+    '''
+    counts = numpy.zeros(3 ** k, dtype=numpy.int32)
+    if len(type_codes) >= k:
+        windows = numpy.lib.stride_tricks.sliding_window_view(type_codes.astype(numpy.int64), k)
+        windows = windows[(windows >= 0).all(axis=1)]
+        numpy.add.at(counts, windows.dot(3 ** numpy.arange(k)), 1)
+    return counts
+
+def collapse_duplicates(sequences):
+    '''
+    Maps each sequence to the first one with an identical sequence string,
+    its representative, so identical sequences are aligned only once.
+    @param sequences: list of NeuriteSequences.
+    @return: list of the index of the representative of each sequence.
+    '''
+    first = {}
+    return [first.setdefault(s.seq, index) for index, s in enumerate(sequences)]
 
 class NeuriteSequence():
     ''' 
@@ -44,6 +136,74 @@ class NeuriteSequence():
     def __init__(self, name, seq):
         self.seq = seq
         self.name = name
+        self.residue_codes = None # cached encodings of seq
+        self.type_codes = None
+        self.encoded_seq = None # seq the cached encodings were built from
+        self.encoded_types = None # node types the cached type codes were built from
+        self.subtrees = None # cached subtree index
+        self.subtree_costs = None # gap costs the cached subtree index was built from
+        self.kmers = None # cached node type k-mer counts
+        self.kmer_k = None # k of the cached k-mer counts
+        
+    def encode(self, node_types=default_nodetypes):
+        ''' 
+        Builds and caches the residue and node type code arrays of the sequence.
+        @param node_types: dictionary of node type to residue characters.
+        '''
+        self.get_type_codes(node_types)
+        
+    def get_residue_codes(self):
+        ''' 
+        Returns the residue codes of the sequence, encoding it if required.
+        @return: uint8 numpy array.
+        '''
+        if self.encoded_seq is not self.seq: # sequence changed since encoding
+            self.residue_codes = encode_residues(self.seq)
+            self.type_codes = None
+            self.subtrees = None
+            self.kmers = None
+            self.encoded_seq = self.seq
+        return self.residue_codes
+    
+    def get_type_codes(self, node_types=default_nodetypes):
+        ''' 
+        Returns the node type codes of the sequence, encoding it if required.
+        @param node_types: dictionary of node type to residue characters.
+        @return: int8 numpy array.
+        '''
+        residue_codes = self.get_residue_codes()
+        if self.type_codes is None or self.encoded_types != node_types:
+            self.type_codes = node_type_lookup(node_types)[residue_codes]
+            self.encoded_types = node_types
+            self.subtrees = None
+            self.kmers = None
+        return self.type_codes
+    
+    def get_subtree_index(self, node_types, gap_costs):
+        ''' 
+        Returns the subtree index of the sequence, building it if required.
+        @param node_types: dictionary of node type to residue characters.
+        @param gap_costs: dictionary of residue to gap cost.
+        @return: paired A position and subtree gap cost arrays (see subtree_index).
+        '''
+        type_codes = self.get_type_codes(node_types)
+        if self.subtrees is None or self.subtree_costs != gap_costs:
+            self.subtrees = subtree_index(type_codes.tolist(), [gap_costs[char] for char in self.seq])
+            self.subtree_costs = gap_costs
+        return self.subtrees
+        
+    def get_kmer_counts(self, k, node_types=default_nodetypes):
+        ''' 
+        Returns the node type k-mer counts of the sequence, counting them if required.
+        @param k: k-mer length.
+        @param node_types: dictionary of node type to residue characters.
+        @return: k-mer counts (see kmer_counts).
+        '''
+        type_codes = self.get_type_codes(node_types)
+        if self.kmers is None or self.kmer_k != k:
+            self.kmers = kmer_counts(type_codes, k)
+            self.kmer_k = k
+        return self.kmers
         
     def get_length(self):
         ''' 
@@ -118,6 +278,32 @@ def tree_sequence_type(seq,node_types=default_nodetypes):
     else:
         return 'multiple_trees_incomplete'
 
+# As tree_sequence_type, given a list of node type codes
+def coded_tree_sequence_type(type_codes):
+    a_nodes = 0
+    complete_trees = 0
+    tree_complete = True
+    for code in type_codes:
+        tree_complete = False
+        if code == type_a:
+            a_nodes += 1
+        elif code == type_t:
+            if a_nodes == 0:
+                complete_trees += 1
+                tree_complete = True
+            else:
+                a_nodes -= 1
+
+    if complete_trees == 0:
+        return 'incomplete_tree'
+    elif tree_complete:
+        if complete_trees == 1:
+            return 'complete_tree'
+        else: # more than one complete tree
+            return 'multiple_trees_complete'
+    else:
+        return 'multiple_trees_incomplete'
+
 class MultipleSequenceAlignment():
     '''
     An object class containing a complete multiple sequence alignment, including component
@@ -0,0 +1,117 @@
+import os
+import unittest
+import engine
+import sequence
+from sequence import NeuriteSequence
+from scoring import ScoringScheme
+from pairwise import PairwiseDriver, ArrayNeedlemanWunsch
+
+# Stands in for parameter.InputWrapperState, which reads its input from the
+# command line arguments and FASTA files
+class InputState():
+    def __init__(self, costs, submat, **args):
+        self.args = {'n': 1, 'a': None, 'o': None}
+        self.args.update(args)
+        self.costs = costs
+        self.submat = submat
+        self.scoring = ScoringScheme(submat, costs)
+
+    def get_args(self):
+        return self.args
+
+    def get_penalties(self):
+        return self.costs
+
+    def get_submatrix(self):
+        return self.submat
+
+    def get_scoring_scheme(self):
+        return self.scoring
+
+    def get_node_types(self):
+        return sequence.default_nodetypes
+
+    def get_engine(self):
+        return 'array'
+
+    def get_engine_options(self):
+        return {}
+
+    def get_alignment_cache(self):
+        return None
+
+# The sequences of a FASTA file, by name
+def read_fasta(fname):
+    seqs = {}
+    with open(fname) as handle:
+        lines = [line.strip() for line in handle if line.strip()]
+    for header, seq in zip(lines[::2], lines[1::2]):
+        name = header[1:].split()[0]
+        seqs[name] = NeuriteSequence(name, seq)
+    return seqs
+
+# Number of gaps in the alignment of s1 to s2
+def num_gaps(s1, s2, scoring):
+    NW = ArrayNeedlemanWunsch(s1, s2, scoring.costs, scoring.submat, scoring.node_types, scoring=scoring)
+    alignment = NW.prettify()[1]
+    return alignment[0].count('-') + alignment[1].count('-')
+
+class TestSymmetricMode(unittest.TestCase):
+    def setUp(self):
+        self.input_state = InputState({'gap': -1, 'gapopen': -2}, sequence.generate_identity_matrix())
+        self.seqs = [NeuriteSequence('a', 'CCC'), NeuriteSequence('b', 'ATCACCCCCTATAT')]
+
+    def test_num_gaps_not_mirrored(self):
+        scoring = self.input_state.get_scoring_scheme()
+        a, b = self.seqs
+        # the gap count of this pair depends on which sequence is the target
+        self.assertNotEqual(num_gaps(a, b, scoring), num_gaps(b, a, scoring))
+        driver = PairwiseDriver(self.seqs, self.seqs, self.input_state, store_pairwise=True,
+                                score_type='num_gaps')
+        self.assertFalse(driver.symmetric)
+        driver.start()
+        self.assertEqual(driver.score_dict['a'][1], num_gaps(a, b, scoring))
+        self.assertEqual(driver.score_dict['b'][0], num_gaps(b, a, scoring))
+
+    def test_alignment_score_mirrored(self):
+        driver = PairwiseDriver(self.seqs, self.seqs, self.input_state, store_pairwise=True)
+        self.assertTrue(driver.symmetric)
+        driver.start()
+        self.assertEqual(driver.score_dict['a'][1], driver.score_dict['b'][0])
+
+class TestBand(unittest.TestCase):
+    def setUp(self):
+        self.costs = {'gap': -1, 'gapopen': 0}
+        self.submat = sequence.generate_identity_matrix()
+        self.scoring = ScoringScheme(self.submat, self.costs)
+        self.seqs = read_fasta(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            'test_data', 'test_seqs.fasta'))
+        # the band of each fill of the kernel
+        self.bands = []
+        fill = engine.TreeAlignmentKernel.fill
+        def record(kernel):
+            self.bands.append(None if kernel.band_lo is None else kernel.band_hi - kernel.band_lo)
+            return fill(kernel)
+        engine.TreeAlignmentKernel.fill = record
+        self.addCleanup(setattr, engine.TreeAlignmentKernel, 'fill', fill)
+
+    def align(self, s1, s2, band):
+        return ArrayNeedlemanWunsch(s1, s2, self.costs, self.submat, self.scoring.node_types,
+                                    scoring=self.scoring, band=band).prettify()
+
+    def test_similar_pair_not_widened(self):
+        s1, s2 = self.seqs['dZI_1-Dendrite'], self.seqs['cZI_3-Dendrite']
+        banded = self.align(s1, s2, 4)
+        self.assertEqual(len(self.bands), 1)
+        self.assertLessEqual(self.bands[0].max(), 8)
+        self.assertEqual(banded, self.align(s1, s2, None))
+
+    def test_band_widened_to_optimum(self):
+        names = sorted(self.seqs)
+        for name1 in names:
+            for name2 in names:
+                s1, s2 = self.seqs[name1], self.seqs[name2]
+                self.assertEqual(self.align(s1, s2, 1), self.align(s1, s2, None))
+
+if __name__ == '__main__':
+    unittest.main()